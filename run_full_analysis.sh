@@ -4,7 +4,7 @@ echo "Check if the mcmc/<chain-name>.hdf is the one you want to append the chain
 #./src/calculations_average_obs.py
 
 #train the emulator
-./src/emulator.py --retrain --nrestarts 4
+./src/emulator.py --nrestarts 4
 
 #perform MCMC
 ./src/bayes_mcmc.py 4000 --nwalkers 100 --nburnsteps 500
@@ -26,7 +26,7 @@ To restart the chain, delete (or rename) the chain HDF5 file.
 """
 
 import argparse
-from contextlib import contextmanager
+from contextlib import contextmanager, nullcontext
 import logging
 logging.getLogger().setLevel(logging.INFO)
 import pandas as pd
@@ -37,13 +37,17 @@ import ptemcee
 import h5py
 import numpy as np
 from scipy.linalg import lapack
+from scipy.linalg import solve_triangular
+from scipy.optimize import minimize
 from multiprocessing import Pool
 from multiprocessing import cpu_count
 
 import matplotlib.pyplot as plt
 from configurations import *
 from emulator import Trained_Emulators, Trained_Emulators_all_df, _Covariance
+from emulator import emulator_registry
 from bayes_exp import Y_exp_data
+from mcmc_diagnostics import chain_autocorrelation
 
 #define groups of observables which are assumed to have correlated experimental error
 expt_obs_corr_group = {
@@ -155,6 +159,125 @@ def normed_mvn_loglike(y, cov):
     return -.5*np.dot(y, alpha) - np.log(L.diagonal()).sum() + norm_const
 
 
+def batched_mvn_loglike(y, cov, normed=False):
+    """
+    Evaluate the multivariate-normal log-likelihood for a batch of difference
+    vectors `y` and covariance matrices `cov` in one vectorized call, i.e. the
+    equivalent of ``list(map(mvn_loglike, y, cov))``.
+
+    Arguments `y` and `cov` MUST be np.arrays with dtype == float64 and shapes
+    (nsamples, n) and (nsamples, n, n), respectively.  These requirements are
+    NOT CHECKED.
+
+    Samples whose covariance is not positive definite get a log-likelihood of
+    -inf, rather than raising an error.
+
+    If `normed` is true, the normalization const is included as in
+    normed_mvn_loglike.
+
+    """
+    lp = np.full(y.shape[0], -np.inf)
+
+    try:
+        L = np.linalg.cholesky(cov)
+        ok = slice(None)
+    except np.linalg.LinAlgError:
+        # At least one covariance is not positive definite.  Find which ones
+        # and only factorize the others.
+        ok = np.array([lapack.dpotrf(c)[1] == 0 for c in cov], dtype=bool)
+        L = np.linalg.cholesky(cov[ok])
+
+    # Solve L.alpha = y, so that y^T.cov^-1.y = alpha^T.alpha.
+    alpha = np.linalg.solve(L, y[ok][:, :, np.newaxis])[:, :, 0]
+
+    lp[ok] = -.5*np.einsum('ij,ij->i', alpha, alpha) \
+        - np.log(np.diagonal(L, axis1=1, axis2=2)).sum(axis=1)
+
+    if normed:
+        n = y.shape[1]
+        lp += -n / ( 2. * np.log(2. * np.pi) )
+
+    return lp
+
+def woodbury_mvn_loglike(r, var, W, G, logdet_S):
+    """
+    Evaluate the multivariate-normal log-likelihood for a batch of samples
+    whose covariance is a fixed matrix S plus a rank-k update:
+
+        cov = S + U^T.diag(var).U
+
+    The fixed part must be pre-factorized as S = L.L^T, and the arguments are
+    given in the whitened frame of L:
+
+        r = L^-1.y             shape (nsamples, n), difference vectors
+        var                    shape (nsamples, k), per-sample variances
+        W = L^-1.U^T           shape (n, k)
+        G = W^T.W              shape (k, k)
+        logdet_S = log(det(S))
+
+    With D = diag(var) and M = I + D^1/2.G.D^1/2, the Woodbury identity and the
+    matrix determinant lemma give
+
+        y^T.cov^-1.y = r^T.r - b^T.M^-1.b,   b = D^1/2.W^T.r
+        log(det(cov)) = log(det(S)) + log(det(M))
+
+    so each sample only requires a (k, k) Cholesky decomposition.
+
+    Returns an array of shape (nsamples) of log-likelihoods, NOT NORMALIZED
+    (see mvn_loglike).
+
+    """
+    sd = np.sqrt(var)
+    b = sd * np.dot(r, W)
+
+    M = sd[:, :, np.newaxis] * G * sd[:, np.newaxis, :]
+    M[:, np.arange(G.shape[0]), np.arange(G.shape[0])] += 1.
+    LM = np.linalg.cholesky(M)
+    c = np.linalg.solve(LM, b[:, :, np.newaxis])[:, :, 0]
+
+    quad = np.einsum('ij,ij->i', r, r) - np.einsum('ij,ij->i', c, c)
+    logdet = logdet_S + 2.*np.log(np.diagonal(LM, axis1=1, axis2=2)).sum(axis=1)
+
+    return -.5*quad - .5*logdet
+
+def woodbury_mvn_loglike_grad(r, var, W, G, logdet_S):
+    """
+    Evaluate woodbury_mvn_loglike (same arguments) and its derivatives with
+    respect to the whitened difference vectors `r` and the variances `var`.
+
+    With a = cov_w^-1.r, where cov_w = I + W.D.W^T is the whitened covariance,
+
+        dlogp/dr = -a
+        dlogp/dvar_k = 1/2*(W^T.a)_k^2 - 1/2*(W^T.cov_w^-1.W)_kk
+
+    and W^T.cov_w^-1.W = G - G.D^1/2.M^-1.D^1/2.G by the Woodbury identity.
+
+    Returns a tuple (logp, dlogp/dr, dlogp/dvar) with shapes (nsamples),
+    (nsamples, n) and (nsamples, k).
+
+    """
+    sd = np.sqrt(var)
+    b = sd * np.dot(r, W)
+
+    M = sd[:, :, np.newaxis] * G * sd[:, np.newaxis, :]
+    M[:, np.arange(G.shape[0]), np.arange(G.shape[0])] += 1.
+    LM = np.linalg.cholesky(M)
+    c = np.linalg.solve(LM, b[:, :, np.newaxis])[:, :, 0]
+
+    quad = np.einsum('ij,ij->i', r, r) - np.einsum('ij,ij->i', c, c)
+    logdet = logdet_S + 2.*np.log(np.diagonal(LM, axis1=1, axis2=2)).sum(axis=1)
+
+    # p = M^-1.b, a = r - W.D^1/2.p
+    p = np.linalg.solve(LM.transpose(0, 2, 1), c[:, :, np.newaxis])[:, :, 0]
+    a = r - np.dot(sd*p, W.T)
+    Wa = np.dot(a, W)
+
+    # diagonal of G.D^1/2.M^-1.D^1/2.G = E^T.E, E = LM^-1.D^1/2.G
+    E = np.linalg.solve(LM, sd[:, :, np.newaxis] * G)
+    H = np.diagonal(G) - np.einsum('ijk,ijk->ik', E, E)
+
+    return -.5*quad - .5*logdet, -a, .5*Wa**2 - .5*H
+
 class LoggingEnsembleSampler(emcee.EnsembleSampler):
     def run_mcmc(self, X0, nsteps, status=None, **kwargs):
         """
@@ -165,7 +288,7 @@ class LoggingEnsembleSampler(emcee.EnsembleSampler):
 
         print('running {:d} walkers for {:d} steps'.format(self.k, nsteps))
         if status is None:
-            status = nsteps // 10
+            status = max(nsteps // 10, 1)
 
         for n, result in enumerate( self.sample(X0, iterations=nsteps, **kwargs), start=1 ):
             if n % status == 0 or n == nsteps:
@@ -206,16 +329,22 @@ class Chain:
     to be the same at all beam energies.  It is assumed (NOT checked) that all
     system designs have the same parameters and ranges (except for the norms).
 
+    The chain is calibrated to `expt_data`, a dict system -> data with the
+    structure of bayes_exp.Y_exp_data (default: Y_exp_data itself), e.g. the
+    model calculations at a validation point for a closure test.
+
     """
-    def __init__(self, path=workdir/'mcmc'/'chain-idf-{:d}.hdf'.format(idf)):
+    def __init__(self, path=workdir/'mcmc'/'chain-idf-{:d}.hdf'.format(idf), expt_data=None):
         self.path = path
         self.path.parent.mkdir(exist_ok=True)
 
         self._slices = {}
         self._expt_y = {}
         self._expt_cov = {}
+        # factors of the Woodbury likelihood, computed on first use
+        self._woodbury = {}
 
-        Yexp = Y_exp_data
+        Yexp = Y_exp_data if expt_data is None else expt_data
 
         # For multi-system calibration, we need to specify what parameters
         # are considered universal (the same across all system), and what
@@ -353,6 +482,88 @@ class Chain:
         return { s: Trained_Emulators_all_df[s][idf].predict(X[:,self.sys_idx[s]], **kwargs) for s in system_strs }
 
 
+    def _predict_pcs(self, X, **kwargs):
+        """
+        Call each system emulator to predict the principal components at X.
+        (using df model specified by idf in configurations.py)
+
+        """
+        if hold_parameters:
+            for (idx, value) in self.hold:
+                X[:,idx] = value
+        return { s: Trained_Emulators[s].predict_pcs(X[:,self.sys_idx[s]], **kwargs) for s in system_strs }
+
+    def _predict_pcs_grad(self, X, **kwargs):
+        """
+        Call each system emulator to predict the principal components and
+        their gradients at X (see Emulator.predict_pcs_grad).
+
+        """
+        if hold_parameters:
+            for (idx, value) in self.hold:
+                X[:,idx] = value
+        return { s: Trained_Emulators[s].predict_pcs_grad(X[:,self.sys_idx[s]], **kwargs) for s in system_strs }
+
+    @property
+    def analytic_gradient(self):
+        """
+        Whether log_posterior_and_grad is available, i.e. the Woodbury
+        likelihood is used and all emulators have the fused GP predictor.
+
+        """
+        return use_woodbury_likelihood and all(
+            Trained_Emulators[s]._fused is not None for s in system_strs
+        )
+
+    def _woodbury_factors(self, sys):
+        """
+        Factorize the fixed part of the likelihood covariance of system `sys`,
+        i.e. the experimental covariance plus the emulator PCA truncation
+        covariance, restricted to the active observables.
+
+        Returns the arguments (W, G, r0, logdet_S) such that for PC means Z the
+        whitened difference vectors are r = Z.W^T + r0 (see woodbury_mvn_loglike).
+
+        """
+        try:
+            return self._woodbury[sys]
+        except KeyError:
+            pass
+
+        emu = Trained_Emulators[sys]
+
+        # indices of the active observables in the emulator output
+        idx = np.concatenate([
+            np.arange(emu.nobs)[emu._slices[obs]] for obs, _ in self._slices[sys]
+        ])
+
+        S = self._expt_cov[sys] + emu._cov_trunc[np.ix_(idx, idx)]
+        L = np.linalg.cholesky(S)
+
+        W = solve_triangular(L, emu._trans_matrix[:emu.npc, idx].T, lower=True)
+        r0 = solve_triangular(L, emu.scaler.mean_[idx] - self._expt_y[sys], lower=True)
+        logdet_S = 2.*np.log(L.diagonal()).sum()
+
+        self._woodbury[sys] = W, np.dot(W.T, W), r0, logdet_S
+        return self._woodbury[sys]
+
+    def _woodbury_log_likelihood(self, X, extra_std, normed=False):
+        """
+        Evaluate the sum over systems of the log likelihood at `X` (all inside
+        the prior range) using the Woodbury update of the fixed covariance.
+
+        """
+        lp = np.zeros(X.shape[0])
+        pred = self._predict_pcs( X, return_var=True, extra_std=extra_std )
+        for sys in system_strs:
+            W, G, r0, logdet_S = self._woodbury_factors(sys)
+            Z, var = pred[sys]
+            lp += woodbury_mvn_loglike(np.dot(Z, W.T) + r0, var, W, G, logdet_S)
+            if normed:
+                n = r0.size
+                lp += -n / ( 2. * np.log(2. * np.pi) )
+        return lp
+
     def log_posterior(self, X, extra_std_prior_scale=0.001):
         """
         Evaluate the posterior at `X`.
@@ -370,7 +581,9 @@ class Chain:
         extra_std = X[inside, -1]
 
         nsamples = np.count_nonzero(inside)
-        if nsamples > 0:
+        if nsamples > 0 and use_woodbury_likelihood:
+            lp[inside] += self._woodbury_log_likelihood(X[inside], extra_std, normed=False)
+        elif nsamples > 0:
             pred = self._predict( X[inside], return_cov=True, extra_std=extra_std )
             for sys in system_strs:
                 nobs = self._expt_y[sys].size
@@ -390,14 +603,68 @@ class Chain:
                 cov += self._expt_cov[sys]
 
                 # compute log likelihood at each point, w/o normalization
-                lp[inside] += list(map(mvn_loglike, dY, cov))
+                lp[inside] += batched_mvn_loglike(dY, cov)
 
+        if nsamples > 0:
             # add prior for extra_std (model sys error)
             lp[inside] += 2*np.log(extra_std) - extra_std/extra_std_prior_scale
 
 
         return lp
 
+    def log_posterior_and_grad(self, X, extra_std_prior_scale=0.001):
+        """
+        Evaluate the posterior at `X` (as log_posterior) and its gradient with
+        respect to `X`, with shape (nsamples, ndim).
+
+        The gradient is analytic: the emulator PC means and variances are
+        differentiated through the GP kernel and transform_design, and the
+        likelihood through its Woodbury form.  It is zero outside the prior
+        range and for held parameters.  Requires analytic_gradient.
+
+        """
+        X = np.array(X, dtype=float, ndmin=2)
+        lp = np.zeros(X.shape[0])
+        grad = np.zeros(X.shape)
+        inside = np.all((X > self.min) & (X < self.max), axis=1)
+        lp[~inside] = -np.inf
+
+        nsamples = np.count_nonzero(inside)
+        if nsamples == 0:
+            return lp, grad
+
+        Xin = X[inside]
+        extra_std = Xin[:, -1]
+        lp_in = np.zeros(nsamples)
+        grad_in = np.zeros(Xin.shape)
+
+        pred = self._predict_pcs_grad( Xin, extra_std=extra_std )
+        for sys in system_strs:
+            W, G, r0, logdet_S = self._woodbury_factors(sys)
+            Z, var, dZ, dvar = pred[sys]
+            ll, dll_dr, dll_dvar = woodbury_mvn_loglike_grad(
+                np.dot(Z, W.T) + r0, var, W, G, logdet_S
+            )
+            lp_in += ll
+            grad_in[:, self.sys_idx[sys]] += (
+                np.einsum('ik,ikd->id', np.dot(dll_dr, W), dZ)
+                + np.einsum('ik,ikd->id', dll_dvar, dvar)
+            )
+            # var includes extra_std^2
+            grad_in[:, -1] += 2*extra_std*dll_dvar.sum(axis=1)
+
+        # add prior for extra_std (model sys error)
+        lp_in += 2*np.log(extra_std) - extra_std/extra_std_prior_scale
+        grad_in[:, -1] += 2/extra_std - 1/extra_std_prior_scale
+
+        if hold_parameters:
+            for (idx, value) in self.hold:
+                grad_in[:, idx] = 0.
+
+        lp[inside] = lp_in
+        grad[inside] = grad_in
+        return lp, grad
+
     def log_prior(self, X):
         """
         Evaluate the prior at `X`.
@@ -431,7 +698,9 @@ class Chain:
         extra_std = X[inside, -1]
 
         nsamples = np.count_nonzero(inside)
-        if nsamples > 0:
+        if nsamples > 0 and use_woodbury_likelihood:
+            lp[inside] += self._woodbury_log_likelihood(X[inside], extra_std, normed=True)
+        elif nsamples > 0:
             pred = self._predict( X[inside], return_cov=True, extra_std=extra_std )
             for sys in system_strs:
                 nobs = self._expt_y[sys].size
@@ -457,8 +726,9 @@ class Chain:
                 cov += self._expt_cov[sys]
 
                 # compute normalized log likelihood at each point
-                lp[inside] += list(map(normed_mvn_loglike, dY, cov))
+                lp[inside] += batched_mvn_loglike(dY, cov, normed=True)
 
+        if nsamples > 0:
             # add prior for extra_std (model sys error)
             lp[inside] += 2*np.log(extra_std) - extra_std/extra_std_prior_scale
 
@@ -482,12 +752,219 @@ class Chain:
         """
         return f(args)
 
-    def run_mcmc(self, nsteps, nburnsteps=None, nwalkers=None, status=None, ntemps=1):
+    def _run_pt_block(self, sampler, p, nsteps, adapt=False):
+        """
+        Advance the PTSampler `sampler` `nsteps` steps from the positions `p`
+        without storing the chain in the sampler.
+
+        Return the final positions at all temperatures, the zero temperature
+        chain of the block, with shape (nwalkers, nsteps, ndim), its log
+        likelihood and log prior, with shape (nwalkers, nsteps), and the
+        walker-mean log likelihood at each temperature summed over the steps.
+
+        """
+        chain = np.empty((sampler.nwalkers, nsteps, self.ndim))
+        log_l = np.empty((sampler.nwalkers, nsteps))
+        log_p = np.empty((sampler.nwalkers, nsteps))
+        logl_sum = np.zeros(sampler.ntemps)
+
+        for i, (p, logpost, logl) in enumerate(sampler.sample(
+                p, iterations=nsteps, storechain=False, adapt=adapt)):
+            chain[:, i, :] = p[0]
+            # the zero temperature has beta = 1
+            log_l[:, i] = logl[0]
+            log_p[:, i] = logpost[0] - logl[0]
+            logl_sum += logl.mean(axis=1)
+
+        return p.copy(), chain, log_l, log_p, logl_sum
+
+    def _save_rng_state(self, state, rng):
+        """
+        Store the MT19937 state tuple `rng` of a np.random.RandomState in the
+        HDF5 group `state`.
+
+        """
+        if 'rng_keys' in state:
+            state['rng_keys'][...] = rng[1]
+        else:
+            state.create_dataset('rng_keys', data=rng[1])
+        state.attrs['rng_pos'] = rng[2]
+        state.attrs['rng_has_gauss'] = rng[3]
+        state.attrs['rng_cached_gaussian'] = rng[4]
+
+    def _load_rng_state(self, state):
+        """
+        Return the MT19937 state tuple stored by _save_rng_state.
+
+        """
+        attrs = state.attrs
+        return (
+            'MT19937', state['rng_keys'][()], int(attrs['rng_pos']),
+            int(attrs['rng_has_gauss']), float(attrs['rng_cached_gaussian'])
+        )
+
+    def _save_pt_state(self, f, sampler, p, nburn_left, logl_sum, nlogl):
+        """
+        Store everything needed to resume the PTSampler `sampler` exactly in
+        the group 'pt_state' of the chain file `f`: the walker positions at
+        all temperatures, the temperature ladder, the random number generator
+        state, the remaining burn-in steps, the log likelihood sums of the
+        evidence estimate and the proposal and swap counts.  Also record the
+        length of the chain, since steps written after the last saved state
+        can not be resumed.
+
+        """
+        state = f.require_group('pt_state')
+
+        for name, data in [
+                ('positions', p),
+                ('betas', sampler.betas),
+                ('logl_sum', logl_sum),
+                ('nprop', sampler.nprop),
+                ('nprop_accepted', sampler.nprop_accepted),
+                ('nswap', sampler.nswap),
+                ('nswap_accepted', sampler.nswap_accepted),
+        ]:
+            if name in state:
+                state[name][...] = data
+            else:
+                state.create_dataset(name, data=data)
+
+        state.attrs['nsteps'] = f['chain'].shape[1]
+        state.attrs['time'] = sampler._time
+        state.attrs['nburn_left'] = nburn_left
+        state.attrs['nlogl'] = nlogl
+        self._save_rng_state(state, sampler._random.get_state())
+
+        f.flush()
+
+    def _load_pt_state(self, f):
+        """
+        Read the PTSampler state written by _save_pt_state.  Return the walker
+        positions, the temperature ladder, the random number generator and
+        the dict of the remaining state.
+
+        """
+        state = f['pt_state']
+        attrs = dict(state.attrs)
+
+        random = np.random.RandomState()
+        random.set_state(self._load_rng_state(state))
+        for name in ['logl_sum', 'nprop', 'nprop_accepted', 'nswap', 'nswap_accepted']:
+            attrs[name] = state[name][()]
+
+        return state['positions'][()], state['betas'][()], random, attrs
+
+    def _save_emcee_state(self, f, sampler):
+        """
+        Store the random number generator state of the emcee `sampler` and
+        the length of the chain in the group 'emcee_state' of the chain file
+        `f`.  With the last walker positions and log posteriors of the chain,
+        this resumes the sampler exactly.
+
+        """
+        state = f.require_group('emcee_state')
+        self._save_rng_state(state, sampler.random_state)
+        state.attrs['nsteps'] = f['chain'].shape[1]
+        f.flush()
+
+    def _write_sampler_info(self, f, sampler):
+        """
+        Write the acceptance fractions of `sampler` to the chain file `f`,
+        and for the PTSampler also the temperature swap acceptance fractions
+        and the temperature ladder, replacing the previous values.
+
+        """
+        info = [('acceptance_fraction', sampler.acceptance_fraction)]
+        if usePTSampler:
+            info += [
+                ('tswap_acceptance_fraction', sampler.tswap_acceptance_fraction),
+                ('betas', sampler.betas),
+            ]
+
+        for name, data in info:
+            if name in f:
+                del f[name]
+            f.create_dataset(name, data=data)
+
+    def _check_convergence(self, dset, target_ess, tau_prev=None, max_steps=1000):
+        """
+        Convergence test of the chain written so far to `dset`, read thinned
+        to at most `max_steps` steps so that the cost of a test does not grow
+        with the chain length: converged if
+        the effective sample size of every parameter reached `target_ess`, or
+        if the chain is longer than 50 autocorrelation times and the
+        autocorrelation time of every parameter changed by less than 1% since
+        the previous test, `tau_prev`.  Return whether the chain converged and
+        the autocorrelation times.  If the thinning exceeds the autocorrelation
+        time, the times are overestimated, which only delays convergence.
+
+        """
+        nwalkers, nsteps, _ = dset.shape
+        thin = -(-nsteps // max_steps)
+        acf, tau, ess = chain_autocorrelation(dset, thin=thin, walkers_per_block=nwalkers)
+        # in steps of the chain
+        tau = tau*thin
+        print(
+            'step {:d}: autocorrelation time: max {:.1f}, '
+            'effective sample size: min {:.0f} (target {:d})'.format(
+            dset.shape[1], tau.max(), ess.min(), target_ess
+            )
+            )
+
+        if ess.min() >= target_ess:
+            print('target effective sample size reached')
+            return True, tau
+
+        if tau_prev is not None and dset.shape[1] > 50*tau.max() \
+                and np.all(np.abs(tau - tau_prev) < .01*tau):
+            print('autocorrelation time estimate stabilized')
+            return True, tau
+
+        return False, tau
+
+    def run_mcmc(self, nsteps, nburnsteps=None, nwalkers=None, status=None, ntemps=1, checkpoint=100,
+                 until_converged=False, target_ess=1000, check_interval=None, nprocs=None,
+                 random=None):
         """
         Run MCMC model calibration.  If the chain already exists, continue from
         the last point, otherwise burn-in and start the chain.
 
+        The chain is appended to the file every `checkpoint` steps, so memory
+        use does not grow with `nsteps`.  The sampler state is saved with each
+        append, so a killed run resumes exactly where it stopped: for the
+        PTSampler the full state (including an unfinished burn-in), for emcee
+        the random number generator state, with the walker positions and log
+        posteriors taken from the last step of the chain.  A killed emcee
+        burn-in is not checkpointed and restarts from the beginning.
+
+        Next to 'chain', both samplers write the acceptance fractions and the
+        log probabilities of every sample, with shape (nwalkers, nsteps): the
+        log likelihood and log prior ('log_likelihood' and 'log_prior') for the
+        PTSampler, the log posterior ('log_posterior') for emcee.  The
+        PTSampler also writes the swap acceptance fractions, the temperature
+        ladder ('betas') and the thermodynamic log evidence (attributes
+        'logZ' and 'dlogZ' of the file).
+
+        If `until_converged`, `nsteps` is the maximum number of steps: every
+        `check_interval` steps the chain written so far is tested with
+        _check_convergence, and the run stops once it converged.  By default
+        the first test is after `checkpoint` steps and the interval doubles
+        after each test.
+
+        The PTSampler evaluates the walkers on `nprocs` processes (default: all
+        CPUs); with ``nprocs=1`` it runs in this process, e.g. in a worker of
+        another pool.
+
+        `random` is the np.random.RandomState of a new sampler and of its
+        initial positions (default: a fresh, unseeded one), for reproducible
+        runs.  A resumed sampler continues with its saved state instead.
+
         """
+        # the interval between convergence tests, doubled after each test
+        # unless given
+        interval = checkpoint if check_interval is None else check_interval
+
         with self.open('a') as f:
             try:
                 dset = f['chain']
@@ -507,79 +984,180 @@ class Chain:
                 burn = False
                 nwalkers = dset.shape[0]
 
+            # log likelihood and log prior of each sample for the PTSampler,
+            # log posterior for emcee; steps of chains written before these
+            # were stored are nan
+            logl_dsets = []
+            for name in (['log_likelihood', 'log_prior'] if usePTSampler else ['log_posterior']):
+                if name not in f:
+                    f.create_dataset(
+                        name, dtype='f8',
+                        shape=dset.shape[:2],
+                        chunks=(nwalkers, 1),
+                        maxshape=(nwalkers, None),
+                        fillvalue=np.nan,
+                        compression='lzf'
+                    )
+                logl_dsets.append(f[name])
+
             #choose number of temperatures for PTSampler
             if usePTSampler:
+                logl_dset, logp_dset = logl_dsets
                 print("Using PTSampler")
-                print("ntemps = " + str(ntemps))
-                ncpu = cpu_count()
+                ncpu = cpu_count() if nprocs is None else nprocs
                 print("{0} CPUs".format(ncpu))
                 Tmax=np.inf
-                with Pool() as pool:
-                    sampler=ptemcee.Sampler(nwalkers, self.ndim, self.log_likelihood, self.log_prior, ntemps, Tmax, pool=pool)
-                    print("Running burn-in phase")
-                    nburn0 = nburnsteps
-                    pos0 = np.random.uniform(self.min, self.max, (ntemps, nwalkers, self.ndim))
-                    start = time.time()
-                    sampler.run_mcmc(pos0, nburn0, adapt=True)
-                    end = time.time()
-                    print("... finished in " + str(end - start) + " sec")
-                    print("sampler.chain.shape " + str(sampler.chain.shape))
+                with (emulator_pool(self, ncpu) if ncpu > 1 else nullcontext()) as pool:
+                    # evaluate all walkers of all temperatures in batches,
+                    # one per worker
+                    evaluator = BatchedEvaluator(self, pool, ncpu)
+                    if 'pt_state' in f:
+                        print('restarting from the saved sampler state')
+                        p, betas, random, state = self._load_pt_state(f)
+                        # drop steps written after the last saved state
+                        for d in [dset, logl_dset, logp_dset]:
+                            d.resize(state['nsteps'], 1)
+                        sampler=ptemcee.Sampler(nwalkers, self.ndim, self.log_likelihood, self.log_prior, betas=betas, pool=evaluator, random=random)
+                        sampler.reset(time=int(state['time']))
+                        for name in ['nprop', 'nprop_accepted', 'nswap', 'nswap_accepted']:
+                            setattr(sampler, name, state[name])
+                        nburn_left = int(state['nburn_left'])
+                        logl_sum = state['logl_sum']
+                        nlogl = int(state['nlogl'])
+                    else:
+                        if nburnsteps is None:
+                            print('must specify nburnsteps to start the PTSampler')
+                            return
+                        print("ntemps = " + str(ntemps))
+                        if random is None:
+                            random = np.random.RandomState()
+                        sampler=ptemcee.Sampler(nwalkers, self.ndim, self.log_likelihood, self.log_prior, ntemps, Tmax, pool=evaluator, random=random)
+                        p = random.uniform(self.min, self.max, (ntemps, nwalkers, self.ndim))
+                        nburn_left = nburnsteps
+                        logl_sum = np.zeros(ntemps)
+                        nlogl = 0
+
+                    if nburn_left > 0:
+                        print("Running burn-in phase")
+                    while nburn_left > 0:
+                        n = min(checkpoint, nburn_left)
+                        start = time.time()
+                        p = self._run_pt_block(sampler, p, n, adapt=True)[0]
+                        nburn_left -= n
+                        self._save_pt_state(f, sampler, p, nburn_left, logl_sum, nlogl)
+                        end = time.time()
+                        print("... " + str(nburn_left) + " burn-in steps left, "
+                              + str(end - start) + " sec")
                     print("betas = " + str(sampler.betas))
-                    #get the last step of the chain
-                    pos0 = sampler.chain[:, :, -1, :]
-                    print("pos0.shape " + str(pos0.shape))
-                    sampler.reset()
+
                     print("Running MCMC chains")
-                    niters = 10
-                    for iter in range(niters):
-                        print("betas = " + str(sampler.betas))
-                        print("iteration " + str(iter) + " ...")
+                    ndone = 0
+                    next_check = interval
+                    tau = None
+                    while ndone < nsteps:
+                        n = min(checkpoint, nsteps - ndone)
                         start = time.time()
-                        sampler.run_mcmc(pos0, nsteps // 10)
+                        p, chain, log_l, log_p, block_logl_sum = self._run_pt_block(sampler, p, n)
+                        #save only the zero temperature chain
+                        for d, data in [(dset, chain), (logl_dset, log_l), (logp_dset, log_p)]:
+                            d.resize(d.shape[1] + n, 1)
+                            d[:, -n:] = data
+                        logl_sum += block_logl_sum
+                        nlogl += n
+                        ndone += n
+                        self._save_pt_state(f, sampler, p, nburn_left, logl_sum, nlogl)
+                        self._write_sampler_info(f, sampler)
                         end = time.time()
-                        logZ, dlogZ = sampler.log_evidence_estimate()
-                        print("logZ = " + str(logZ) + " +/- " + str(dlogZ))
-                        print("... finished in " + str(end - start) + " sec")
-
-
-                print("sampler.chain.shape " + str(sampler.chain.shape))
-                print('writing chain to file')
-                dset.resize(dset.shape[1] + nsteps, 1)
-                #save only the zero temperature chain
-                dset[:, -nsteps:, :] = sampler.chain[0, :, :, :]
-
-                #save the thermodynamic log evidence
-                #logZ, dlogZ = sampler.thermodynamic_integration_log_evidence()
-                logZ, dlogZ = sampler.log_evidence_estimate()
-                print("logZ = " + str(logZ) + " +/- " + str(dlogZ))
-                with open('mcmc/chain-idf-' + str(idf) + '-info.dat', 'w') as f:
-                    f.write('logZ ' + str(logZ) + '\n')
-                    f.write('dlogZ ' + str(dlogZ))
+                        print("step " + str(ndone) + " of " + str(nsteps)
+                              + " finished in " + str(end - start) + " sec")
+                        if until_converged and ndone >= next_check:
+                            if check_interval is None:
+                                interval *= 2
+                            next_check += interval
+                            converged, tau = self._check_convergence(dset, target_ess, tau)
+                            if converged:
+                                break
+
+                print("chain.shape " + str(dset.shape))
+
+                #save the thermodynamic log evidence, from the mean log
+                #likelihoods at each temperature over all production steps
+                if nlogl > 0:
+                    logZ, dlogZ = ptemcee.util.thermodynamic_integration_log_evidence(
+                        sampler.betas, logl_sum / nlogl
+                    )
+                    print("logZ = " + str(logZ) + " +/- " + str(dlogZ))
+                    f.attrs['logZ'] = logZ
+                    f.attrs['dlogZ'] = dlogZ
+                    with open(self.path.with_name(self.path.stem + '-info.dat'), 'w') as finfo:
+                        finfo.write('logZ ' + str(logZ) + '\n')
+                        finfo.write('dlogZ ' + str(dlogZ))
 
 
             else:
+                logpost_dset, = logl_dsets
                 sampler = LoggingEnsembleSampler(nwalkers, self.ndim, self.log_posterior, pool=self)
+                if random is not None:
+                    sampler.random_state = random.get_state()
+                lnprob0 = None
+                if 'emcee_state' in f:
+                    state = f['emcee_state']
+                    # drop steps written after the last saved state
+                    for d in [dset, logpost_dset]:
+                        d.resize(state.attrs['nsteps'], 1)
+                    sampler.random_state = self._load_rng_state(state)
+                # the chain is only written after the burn-in, so an empty
+                # chain is from a killed burn-in
+                if dset.shape[1] == 0:
+                    if nburnsteps is None:
+                        print('must specify nburnsteps to start chain')
+                        return
+                    burn = True
                 if burn:
                     print('no existing chain found, starting initial burn-in')
                     # Run first half of burn-in starting from random positions.
                     nburn0 = nburnsteps // 2
-                    sampler.run_mcmc( self.random_pos(nwalkers), nburn0, status=status )
+                    X0 = self.random_pos(nwalkers) if random is None \
+                        else random.uniform(self.min, self.max, (nwalkers, self.ndim))
+                    sampler.run_mcmc( X0, nburn0, status=status )
                     print('resampling walker positions')
                     # Reposition walkers to the most likely points in the chain,
                     # then run the second half of burn-in.  This significantly
                     # accelerates burn-in and helps prevent stuck walkers.
                     X0 = sampler.flatchain[ np.unique( sampler.flatlnprobability, return_index=True )[1][-nwalkers:] ]
                     sampler.reset()
-                    X0 = sampler.run_mcmc(X0, nburnsteps - nburn0, status=status, storechain=False)[0]
+                    X0, lnprob0 = sampler.run_mcmc(X0, nburnsteps - nburn0, status=status, storechain=False)[:2]
                     sampler.reset()
                     print('burn-in complete, starting production')
                 else:
                     print('restarting from last point of existing chain')
                     X0 = dset[:, -1, :]
-                sampler.run_mcmc(X0, nsteps, status=status)
-                print('writing chain to file')
-                dset.resize(dset.shape[1] + nsteps, 1)
-                dset[:, -nsteps:, :] = sampler.chain
+                    lnprob0 = logpost_dset[:, -1]
+                    # chains written before the log posterior was stored
+                    if np.isnan(lnprob0).any():
+                        lnprob0 = None
+                ndone = 0
+                next_check = interval
+                tau = None
+                while ndone < nsteps:
+                    n = min(checkpoint, nsteps - ndone)
+                    X0, lnprob0 = sampler.run_mcmc(X0, n, status=status, lnprob0=lnprob0)[:2]
+                    print('writing chain to file')
+                    for d in [dset, logpost_dset]:
+                        d.resize(d.shape[1] + n, 1)
+                    dset[:, -n:, :] = sampler.chain
+                    logpost_dset[:, -n:] = sampler.lnprobability
+                    self._write_sampler_info(f, sampler)
+                    self._save_emcee_state(f, sampler)
+                    sampler.reset()
+                    ndone += n
+                    if until_converged and ndone >= next_check:
+                        if check_interval is None:
+                            interval *= 2
+                        next_check += interval
+                        converged, tau = self._check_convergence(dset, target_ess, tau)
+                        if converged:
+                            break
 
     def open(self, mode='r'):
         """
@@ -612,6 +1190,132 @@ class Chain:
         with self.dataset() as d:
             return np.array(d[:, ::thin, indices]).reshape(-1, ndim)
 
+    def map_bounds(self, eps=1e-6):
+        """
+        Bounds of the MAP search: the prior range, shrunk by a fraction `eps`
+        of its width so that the posterior is finite on the bounds.
+
+        """
+        width = self.max - self.min
+        return self.min + eps*width, self.max - eps*width
+
+    def map_starts(self, nlhs=20, nquantiles=3, ntop=10, seed=None):
+        """
+        Starting points of the MAP search: `nlhs` points of a Latin hypercube
+        over the prior, and if the chain exists, the `nquantiles` points of
+        equal chain quantiles between the 25th and 75th percentile and the
+        `ntop` samples of highest log likelihood in the chain (from the
+        stored log likelihood, or log posterior for emcee, if available,
+        otherwise among 1000 samples).
+
+        """
+        random = np.random.RandomState(seed)
+        lo, hi = self.map_bounds()
+
+        # Latin hypercube: one point in each of nlhs strata per parameter
+        u = (np.array([random.permutation(nlhs) for _ in range(self.ndim)]).T
+             + random.uniform(size=(nlhs, self.ndim))) / nlhs
+        starts = [lo + u*(hi - lo)]
+
+        nsteps = 0
+        if self.path.exists():
+            with self.open() as f:
+                if 'chain' in f:
+                    nsteps = f['chain'].shape[1]
+
+        if nsteps > 0:
+            summary = self.summary()
+            starts.append(summary.quantile(np.linspace(.25, .75, nquantiles)).T)
+
+            with self.open() as f:
+                name = 'log_likelihood' if 'log_likelihood' in f else 'log_posterior'
+                logl = np.array(f[name]) if name in f else np.nan
+                if np.isfinite(logl).any():
+                    logl = np.nan_to_num(logl, nan=-np.inf)
+                    top = np.argsort(logl, axis=None)[-ntop:]
+                    starts.append(np.array([
+                        f['chain'][w, s] for w, s in zip(*np.unravel_index(top, logl.shape))
+                    ]))
+                else:
+                    X = self.draw(1000)
+                    starts.append(X[np.argsort(self.log_posterior(X))[-ntop:]])
+
+        return np.clip(np.concatenate(starts), lo, hi)
+
+    def find_map(self, starts=None, nprocs=None, **kwargs):
+        """
+        Find the maximum a posteriori (MAP) point by local optimization
+        (optimize_map) from many `starts` (default: map_starts, which takes
+        `kwargs`), spread over `nprocs` processes (default: all CPUs).
+
+        Return the best optimum and the list of all distinct local optima,
+        best first, as scipy OptimizeResult with `x` the parameters and `fun`
+        the negative log posterior.
+
+        """
+        if starts is None:
+            starts = self.map_starts(**kwargs)
+        print("Optimizing from " + str(len(starts)) + " starting points")
+
+        nprocs = cpu_count() if nprocs is None else nprocs
+        if nprocs > 1:
+            with emulator_pool(self, nprocs) as pool:
+                results = pool.map(worker_optimize_map, starts)
+        else:
+            results = [optimize_map(self, x0) for x0 in starts]
+
+        # distinct local optima, best first
+        lo, hi = self.map_bounds()
+        optima = []
+        for res in sorted(results, key=lambda res: res.fun):
+            if all(np.abs((res.x - opt.x)/(hi - lo)).max() > 1e-3 for opt in optima):
+                optima.append(res)
+
+        return optima[0], optima
+
+    def write_map(self, x, path=None):
+        """
+        Write the MAP parameters `x` to `path` (default:
+        mcmc/MAP-idf-<idf>.dat), one line per system with the parameters of
+        its design (its normalization followed by the common parameters),
+        which configurations.py loads into MAP_params.
+
+        """
+        if path is None:
+            path = workdir/'mcmc'/'MAP-idf-{:d}.dat'.format(idf)
+
+        with open(path, 'w') as f:
+            f.write('# system, MAP parameters\n')
+            for s in system_strs:
+                f.write(s + ' ' + ' '.join('{:.6g}'.format(v) for v in x[self.sys_idx[s]]) + '\n')
+
+    def summary(self, thin=1, bins=50, pairs=(), steps_per_block=1000):
+        """
+        Compute the ChainSummary (mean, covariance, quantiles, credible
+        intervals and histograms) of every `thin`'th step of the chain,
+        reading `steps_per_block` steps at a time, so memory use does not
+        depend on the chain length.
+
+        """
+        summary = ChainSummary(self.range, bins=bins, pairs=pairs)
+
+        with self.dataset() as d:
+            nsteps = d.shape[1]
+            for start in range(0, nsteps, steps_per_block*thin):
+                X = d[:, start:start + steps_per_block*thin:thin]
+                summary.update(X.reshape(-1, d.shape[2]))
+
+        return summary
+
+    def load_log_likelihood(self, thin=1):
+        """
+        Read the log likelihood of the samples stored next to the chain, in
+        the same order as load.  Read only every `thin`'th sample.
+
+        """
+        with self.dataset(name='log_likelihood') as d:
+            return np.array(d[:, ::thin]).ravel()
+
     def load_wo_reshape(self, thin=1):
         """
         Read the chain from file.  If `keys` are given, read only those
@@ -625,18 +1329,39 @@ class Chain:
             #return np.array(d[:, ::thin, indices]).reshape(-1, ndim)
             return np.array(d[:, ::thin, indices])
 
+    def draw(self, n=1):
+        """
+        Return `n` parameter points drawn at random from the chain, with
+        shape (n, ndim).
+
+        The random (walker, step) indices are grouped by HDF5 chunk and each
+        chunk is read once, instead of one read per point.
+
+        """
+        with self.dataset() as d:
+            walkers, steps = [np.random.randint(s, size=n) for s in d.shape[:2]]
+            # number of steps per chunk
+            nchunk = d.chunks[1] if d.chunks is not None else d.shape[1]
+
+            X = np.empty((n, d.shape[2]))
+            order = np.argsort(steps, kind='stable')
+            chunk_idx = steps[order] // nchunk
+            for group in np.split(order, np.flatnonzero(np.diff(chunk_idx)) + 1):
+                if group.size == 0:
+                    continue
+                start = steps[group[0]] // nchunk * nchunk
+                block = d[:, start:start + nchunk]
+                X[group] = block[walkers[group], steps[group] - start]
+
+        return X
+
     def samples(self, n=1):
         """
         Predict model output at `n` parameter points randomly drawn from the
         chain. (Uses emulator given by idf setting in configurations.py)
 
         """
-        with self.dataset() as d:
-            X = np.array([
-                d[i] for i in zip(*[
-                    np.random.randint(s, size=n) for s in d.shape[:2]
-                ])
-            ])
+        X = self.draw(n)
 
         return self._predict(X)
 
@@ -646,16 +1371,266 @@ class Chain:
         chain using a specific df model emulator selected by input argument.
 
         """
-        with self.dataset() as d:
-            X = np.array([
-                d[i] for i in zip(*[
-                    np.random.randint(s, size=n) for s in d.shape[:2]
-                ])
-            ])
+        X = self.draw(n)
 
         return self._predict_given_df(X, idf)
 
 
+class ChainSummary:
+    """
+    Summary statistics of MCMC samples accumulated block by block with
+    update, so that the samples never need to be in memory at once: the
+    mean and covariance, 1D histograms over the parameter `ranges`, and
+    optionally 2D histograms of the parameter `pairs`, all with `bins` bins.
+
+    Quantiles and credible intervals are computed from 1D histograms of
+    `nfine` bins, so they are approximate to 1/nfine of the parameter range.
+
+    """
+    def __init__(self, ranges, bins=50, pairs=(), nfine=4000):
+        self.ranges = np.array(ranges, dtype=float)
+        ndim = len(self.ranges)
+        self.bins = bins
+        self.nfine = nfine
+
+        self.n = 0
+        self.mean = np.zeros(ndim)
+        self._comoment = np.zeros((ndim, ndim))
+        self.min = np.full(ndim, np.inf)
+        self.max = np.full(ndim, -np.inf)
+
+        self._fine_hist = np.zeros((ndim, nfine))
+        self.hist2d = {tuple(pair): np.zeros((bins, bins)) for pair in pairs}
+
+    def _bin_index(self, X, nbins):
+        lo, hi = self.ranges.T
+        idx = ((X - lo) / (hi - lo) * nbins).astype(int)
+        return np.clip(idx, 0, nbins - 1)
+
+    def update(self, X):
+        """
+        Add the samples `X`, with shape (n, ndim).
+
+        """
+        X = np.array(X, ndmin=2)
+        m = X.shape[0]
+        if m == 0:
+            return
+
+        # merge the mean and co-moment of the block (Chan et al.)
+        mean = X.mean(axis=0)
+        dX = X - mean
+        delta = mean - self.mean
+        n = self.n + m
+        self._comoment += np.dot(dX.T, dX) + np.outer(delta, delta) * self.n * m / n
+        self.mean += delta * m / n
+        self.n = n
+
+        self.min = np.minimum(self.min, X.min(axis=0))
+        self.max = np.maximum(self.max, X.max(axis=0))
+
+        for k, idx in enumerate(self._bin_index(X, self.nfine).T):
+            self._fine_hist[k] += np.bincount(idx, minlength=self.nfine)
+
+        if self.hist2d:
+            idx = self._bin_index(X, self.bins)
+            for (k1, k2), H in self.hist2d.items():
+                H += np.bincount(
+                    idx[:, k1]*self.bins + idx[:, k2], minlength=self.bins**2
+                ).reshape(self.bins, self.bins)
+
+    @property
+    def cov(self):
+        return self._comoment / (self.n - 1)
+
+    def _fine_edges(self, k):
+        return np.linspace(*self.ranges[k], self.nfine + 1)
+
+    def _fine_cdf(self, k):
+        return np.concatenate([[0.], np.cumsum(self._fine_hist[k])]) / self.n
+
+    def histogram(self, k, bins=None, range=None, density=False):
+        """
+        Return the histogram of parameter `k` with `bins` (default: the
+        summary's bins) equal bins over `range` (default: its full range),
+        and the bin edges.
+
+        """
+        edges = np.linspace(
+            *(self.ranges[k] if range is None else range),
+            (self.bins if bins is None else bins) + 1
+        )
+        H = np.diff(np.interp(edges, self._fine_edges(k), self._fine_cdf(k)))
+        if density:
+            return H / np.diff(edges), edges
+        return H * self.n, edges
+
+    def histogram2d(self, k1, k2):
+        """
+        Return the 2D histogram of the parameters `k1`, `k2` (which must be one
+        of the pairs) and the bin edges of both parameters.
+
+        """
+        edges = [np.linspace(*self.ranges[k], self.bins + 1) for k in (k1, k2)]
+        return self.hist2d[(k1, k2)], edges[0], edges[1]
+
+    def quantile(self, q):
+        """
+        Return the approximate quantiles `q` of each parameter, with shape
+        (ndim,) + shape of `q`.
+
+        """
+        return np.array([
+            np.interp(q, self._fine_cdf(k), self._fine_edges(k))
+            for k in range(len(self.ranges))
+        ])
+
+    def median(self):
+        return self.quantile(.5)
+
+    def credible_interval(self, ci=.9):
+        """
+        Return the approximate shortest intervals containing a fraction `ci`
+        of the samples of each parameter (as credible_interval), with shape
+        (ndim, 2).
+
+        """
+        intervals = []
+        for k in range(len(self.ranges)):
+            cdf = self._fine_cdf(k)
+            edges = self._fine_edges(k)
+            # for each lower edge, the first upper edge enclosing ci
+            upper = np.searchsorted(cdf, cdf + ci - 1e-12)
+            valid = upper <= self.nfine
+            lower = np.flatnonzero(valid)
+            width = edges[upper[valid]] - edges[lower]
+            i = lower[np.argmin(width)]
+            intervals.append((edges[i], edges[upper[i]]))
+        return np.array(intervals)
+
+
+def log_likelihood_and_prior(chain, X):
+    """
+    Evaluate the likelihood and prior of `chain` at every point of `X` in one
+    batched call.  As for ptemcee, the likelihood is 0 where the prior
+    vanishes.
+
+    """
+    logp = chain.log_prior(X)
+    logl = chain.log_likelihood(X)
+    logl[logp == -np.inf] = 0
+
+    if np.isnan(logl).any():
+        raise ValueError('Log likelihood function returned NaN.')
+
+    return logl, logp
+
+
+def map_objective(x, chain, lo, hi, rel_step=1e-6):
+    """
+    Negative log posterior of `chain` at `x` and its gradient.  The gradient
+    is analytic if the chain has analytic_gradient, otherwise by forward
+    finite differences, all evaluated in one batched log_posterior call.
+    Steps that would leave the bounds `lo`, `hi` are taken backwards.
+
+    """
+    if chain.analytic_gradient:
+        lp, grad = chain.log_posterior_and_grad(x)
+        return -lp[0], -grad[0]
+
+    h = rel_step*(hi - lo)
+    h = np.where(x + h > hi, -h, h)
+    lp = chain.log_posterior(np.vstack([x, x + np.diag(h)]))
+
+    return -lp[0], -(lp[1:] - lp[0])/h
+
+def optimize_map(chain, x0, tol=1e-7):
+    """
+    Maximize the posterior of `chain` with L-BFGS-B from `x0`, within the
+    chain's map_bounds.
+
+    """
+    lo, hi = chain.map_bounds()
+    return minimize(
+        map_objective, x0, args=(chain, lo, hi), jac=True,
+        method='L-BFGS-B', bounds=list(zip(lo, hi)), tol=tol
+    )
+
+
+# the Chain of a worker process of emulator_pool
+_worker_chain = None
+
+def _init_worker(chain):
+    global _worker_chain
+    _worker_chain = chain
+    # no-op if the emulators were loaded before forking
+    emulator_registry.preload(systems=system_strs)
+
+def worker_log_likelihood_and_prior(X):
+    """
+    log_likelihood_and_prior of the worker's chain, for use with
+    emulator_pool.
+
+    """
+    return log_likelihood_and_prior(_worker_chain, X)
+
+def worker_optimize_map(x0):
+    """
+    optimize_map of the worker's chain, for use with emulator_pool.
+
+    """
+    return optimize_map(_worker_chain, x0)
+
+def emulator_pool(chain, processes=None):
+    """
+    Return a Pool of `processes` (default: all CPUs) persistent workers that
+    hold `chain` and the emulators of all systems.
+
+    The chain is handed to each worker once, by the pool initializer, so tasks
+    of worker_log_likelihood_and_prior only send the walker positions and
+    return the log-probabilities.  The emulators are loaded from their
+    compact files, which are memory-mapped, so the GP and PCA arrays are
+    shared by all workers instead of copied.  They are loaded in the parent
+    before forking, so that the workers inherit them.
+
+    """
+    emulator_registry.preload(systems=system_strs)
+    return Pool(processes, initializer=_init_worker, initargs=(chain,))
+
+
+class BatchedEvaluator:
+    """
+    'pool' for :class:`ptemcee.Sampler` that evaluates the walkers of all
+    temperatures of a step in one batched call, instead of one call per
+    walker.
+
+    ptemcee maps its likelihood-prior wrapper over the rows of the
+    ``(ntemps*nwalkers, ndim)`` array of proposed positions; this object
+    ignores the wrapper, stacks the rows and evaluates
+    log_likelihood_and_prior of `chain` on them at once, then returns the
+    ``(logl, logp)`` pairs in row order.  If a `pool` from emulator_pool is
+    given, the rows are split into `nchunks` blocks evaluated by its workers.
+
+    """
+    def __init__(self, chain, pool=None, nchunks=None):
+        self.chain = chain
+        self.pool = pool
+        self.nchunks = cpu_count() if nchunks is None else nchunks
+
+    def map(self, f, rows):
+        X = np.array(rows, ndmin=2)
+
+        if self.pool is None:
+            logl, logp = log_likelihood_and_prior(self.chain, X)
+        else:
+            blocks = [b for b in np.array_split(X, self.nchunks) if b.size > 0]
+            results = self.pool.map(worker_log_likelihood_and_prior, blocks)
+            logl = np.concatenate([r[0] for r in results])
+            logp = np.concatenate([r[1] for r in results])
+
+        return list(zip(logl, logp))
+
+
 def credible_interval(samples, ci=.9):
     """
     Compute the highest-posterior density (HPD) credible interval (default 90%)
@@ -680,7 +1655,7 @@ def main():
 
     parser.add_argument(
         'nsteps', type=int,
-        help='number of steps'
+        help='number of steps (maximum number with --until-converged)'
     )
     parser.add_argument(
         '--nwalkers', type=int,
@@ -698,6 +1673,24 @@ def main():
         '--status', type=int,
         help='number of steps between logging status'
     )
+    parser.add_argument(
+        '--checkpoint', type=int, default=100,
+        help='number of steps between writes of the chain (and sampler state)'
+    )
+    parser.add_argument(
+        '--until-converged', action='store_true',
+        help='stop before nsteps once the target effective sample size is '
+             'reached or the autocorrelation time estimate is stable'
+    )
+    parser.add_argument(
+        '--target-ess', type=int, default=1000,
+        help='effective sample size per parameter for --until-converged'
+    )
+    parser.add_argument(
+        '--check-interval', type=int,
+        help='number of steps between convergence tests '
+             '(default: checkpoint, doubled after each test)'
+    )
 
     args = parser.parse_args()
     Chain().run_mcmc(
@@ -705,7 +1698,11 @@ def main():
             nwalkers=args.nwalkers,
             nburnsteps=args.nburnsteps,
             status=args.status,
-            ntemps=args.ntemps
+            ntemps=args.ntemps,
+            checkpoint=args.checkpoint,
+            until_converged=args.until_converged,
+            target_ess=args.target_ess,
+            check_interval=args.check_interval
           )
 
 
@@ -51,7 +51,7 @@ from SALib.analyze import sobol
 
 from bayes_mcmc import Chain, credible_interval
 from configurations import *
-from emulator import Trained_Emulators, _Covariance
+from emulator import Trained_Emulators, _Covariance, load_emulator
 from calculations_load import trimmed_model_data, MAP_data
 from bayes_exp import Y_exp_data
 from design import Design
@@ -837,7 +837,7 @@ def observables_fit_MAP():
                 if system == 'Au-Au-200':
                     expt_label='STAR'
                     expt_marker='.'
-                emu = dill.load(open('emulator/emulator-' + system + '-idf-' + str(idf) + '.dill', "rb"))
+                emu = load_emulator(system)
 
                 axes[row][col].tick_params(labelsize=11)
 
@@ -1087,7 +1087,7 @@ def observables_fit_model_calc_compare():
                 if system == 'Au-Au-200':
                     expt_label='STAR'
                     expt_marker='.'
-                emu = dill.load(open('emulator/emulator-' + system + '-idf-' + str(idf) + '.dill', "rb"))
+                emu = load_emulator(system)
 
                 axes[row][col].tick_params(labelsize=11)
 
@@ -1615,16 +1615,11 @@ def viscous_posterior(plot_samples = False):
         true_zetas = zeta_over_s(T, *tp[11:15])
 
     chain = Chain(path=workdir/'mcmc'/'chain-idf-0_LHC_RHIC_PTEMCEE.hdf')
-    data = chain.load_wo_reshape()
-    if num_systems == 1:
-        data = data.reshape(-1, 18)
-    elif num_systems == 2:
-        data = data.reshape(-1, 19)
-
-    index = np.random.choice(np.arange(data.shape[0]), 50000)
+    #draw the samples without loading the whole chain
+    data = chain.draw(50000)
 
     design, dmin, dmax, labels = load_design(system_str=system_strs[0], pset='main')
-    samples = data[index, 1:]
+    samples = data[:, 1:]
     fig, axes = plt.subplots(nrows=1, ncols=2, figsize=(5,3),
                     sharex=False, sharey=False, constrained_layout=True)
     fig.suptitle("Viscosity Posterior : " + idf_label[idf], fontsize=qm_font_large, wrap=True)
@@ -3244,54 +3239,26 @@ def find_map():
     to experimental data. (Plotting is Deprecated - needs update)
 
     """
-    from scipy.optimize import minimize
-    from scipy.optimize import basinhopping
-
     chain = Chain(path=workdir/'mcmc'/'chain-idf-{:d}_LHC_RHIC_PTEMCEE.hdf'.format(idf))
 
-    fixed_params = {
-        #'trento_p': 0.,
-        #'etas_min': .08,
-        #'etas_hrg': .3,
-        #'model_sys_err': .1,
-    }
-
-    opt_params = [k for k in chain.labels if k not in fixed_params]
-
-    def full_x(x):
-        x = dict(zip(opt_params, x), **fixed_params)
-        return [x[k] for k in chain.labels]
-
     print("####################################################")
     print("Minimizing -log(Posterior) to find MAP parameters...")
-    bounds=[
-        (a + 1e-6*(b - a), b - 1e-6*(b - a))
-        for (a, b), k in zip(chain.range, chain.labels)
-        if k in opt_params
-    ]
-    #minimizer_kwargs = dict(method="L-BFGS-B", bounds=bounds)
-    x0 = np.median(chain.load(), axis=0)
-    #res = basinhopping(
-    #        lambda x: -chain.log_posterior(full_x(x))[0],
-    #        x0,
-    #        minimizer_kwargs=minimizer_kwargs
-    #        )
-    #NOTE scipy.optimize minimize finds local minima not global minima
-    res = minimize(
-        lambda x: -chain.log_posterior(full_x(x))[0],
-        x0 = x0,
-        tol = 1e-7,
-        bounds=bounds
-        )
+    #NOTE the optimizer finds local minima, so start from many points
+    res, optima = chain.find_map()
 
     print('optimization result:\n%s', res)
+    print(str(len(optima)) + ' distinct local optima, -log(Posterior) = '
+          + str([round(opt.fun, 3) for opt in optima]))
     width = max(map(len, chain.labels)) + 2
     print(
         'MAP params:\n%s',
         '\n'.join(
-            k.ljust(width) + str(x) for k, x in zip(chain.labels, full_x(res.x))
+            k.ljust(width) + str(x) for k, x in zip(chain.labels, res.x)
         )
     )
+    #write the MAP parameters for configurations.py
+    chain.write_map(res.x)
+
     systems_title = ''
     for s in system_strs:
         systems_title += (' ' + s)
@@ -3301,8 +3268,7 @@ def find_map():
         myfile.write('| --------- | --------- |\n')
         myfile.write(
             '\n'.join(
-                #k.ljust(width) + str(x) for k, x in zip(chain.keys, full_x(res.x))
-                '|'+k+'|'+str(round(x, 3))+'|' for k, x in zip(chain.labels, full_x(res.x))
+                '|'+k+'|'+str(round(x, 3))+'|' for k, x in zip(chain.labels, res.x)
             )
         )
 
@@ -3310,7 +3276,7 @@ def find_map():
 
     #the following plot is deprectaed, needs to be updated to work.
     """
-    pred = chain._predict(np.atleast_2d(full_x(res.x)))
+    pred = chain._predict(np.atleast_2d(res.x))
 
     plots = _observables_plots()
 
@@ -3423,6 +3389,14 @@ def format_ci(samples, ci=.9):
     """
     cil, cih = credible_interval(samples, ci=ci)
     median = np.median(samples)
+
+    return format_median_ci(median, cil, cih)
+
+def format_median_ci(median, cil, cih):
+    """
+    Return a TeX-formatted string of a median and credible interval.
+
+    """
     ul = median - cil
     uh = cih - median
 
@@ -3673,16 +3647,18 @@ def information_gain():
     set_tight(pad=.0, h_pad=.0, w_pad=.0, rect=(.01, 0, 1, 1))
 
 
-def _posterior_diag():
+def _posterior_diag(chain=None, truths=None):
 
     """
     Plots histograms of the 1d marginal distributions of model parameters,
-    given by MCMC chain. If doing validation (closure test), also plots the true values.
+    given by MCMC chain (default: Chain()). If doing validation (closure test),
+    or if the true values `truths` are given, also plots the true values.
     """
 
-    chain = Chain()
+    if chain is None:
+        chain = Chain()
 
-    if validation:
+    if validation and truths is None:
         truths = []
         #get VALIDATION points
         for s in system_strs:
@@ -3691,11 +3667,13 @@ def _posterior_diag():
             truths.append(v_design.values[validation_pt,0])
         truths = truths + list(v_design.values[validation_pt,1:]) + [-1]
 
-
+    if truths is not None:
         labels = chain.labels
         ranges = chain.range
-        data = chain.load().T
-        ndims, nsamples = data.shape
+        #summarize the chain block by block instead of loading it
+        summary = chain.summary()
+        medians = summary.median()
+        intervals = summary.credible_interval()
 
 
         cmap = plt.get_cmap('Blues')
@@ -3704,11 +3682,12 @@ def _posterior_diag():
         fig, axes = plt.subplots(nrows=4, ncols=5, figsize=(8, 6) )
         fig.suptitle("Parameters Posterior : " + idf_label[idf] + " Visc. Correction ")
 
-        for ax, x, xlabel, xlim, truth in zip(axes.flatten(), data, labels, ranges, truths):
+        for k, (ax, xlabel, xlim, truth) in enumerate(zip(axes.flatten(), labels, ranges, truths)):
 
-                H, _, _ = ax.hist(x, bins=21, histtype='step', density=True)
+                H, edges = summary.histogram(k, bins=21, density=True)
+                ax.hist(edges[:-1], bins=edges, weights=H, histtype='step')
 
-                stex = format_ci(x)
+                stex = format_median_ci(medians[k], *intervals[k])
                 ax.annotate(stex, xy=(.75, .8), xycoords="axes fraction", ha='center', va='bottom', fontsize=6)
                 ax.set_xlim(*xlim)
                 ax.axvline(x=truth, color='r')
@@ -3728,21 +3707,23 @@ def _posterior_diag():
 
     else :
         labels = chain.labels
-        ranges = chain.range
-        data = chain.load().T
-        ndims, nsamples = data.shape
-        ranges = np.array([np.min(data, axis=1), np.max(data, axis=1)]).T
+        #summarize the chain block by block instead of loading it
+        summary = chain.summary()
+        medians = summary.median()
+        intervals = summary.credible_interval()
+        ranges = np.array([summary.min, summary.max]).T
 
         cmap = plt.get_cmap('Blues')
         cmap.set_bad('white')
 
         fig, axes = plt.subplots(nrows=4, ncols=5, figsize=(6, 4.5) )
 
-        for ax, x, xlabel, xlim in zip(axes.flatten(), data, labels, ranges):
+        for k, (ax, xlabel, xlim) in enumerate(zip(axes.flatten(), labels, ranges)):
 
-                H, _, _ = ax.hist(x, bins=21, histtype='step', density=True)
+                H, edges = summary.histogram(k, bins=21, range=xlim, density=True)
+                ax.hist(edges[:-1], bins=edges, weights=H, histtype='step')
 
-                stex = format_ci(x)
+                stex = format_median_ci(medians[k], *intervals[k])
                 ax.annotate(stex, xy=(.75, .8), xycoords="axes fraction", ha='center', va='bottom', fontsize=6)
                 ax.set_xlim(*xlim)
                 ax.set_ylim(0, H.max()*1.25)
@@ -3785,9 +3766,9 @@ def observables_sensitivity():
     plt.suptitle("Sensitivity Indices at Mean Parameters : " + cent_bin_label[cent_bin] + " Cent.")
     #load the emulator
     for system in system_strs:
-        emu0 = dill.load(open('emulator/emulator-' + 'Pb-Pb-2760' + '-idf-0.dill', "rb"))
-        emu1 = dill.load(open('emulator/emulator-' + 'Pb-Pb-2760' + '-idf-1.dill', "rb"))
-        emu3 = dill.load(open('emulator/emulator-' + 'Pb-Pb-2760' + '-idf-3.dill', "rb"))
+        emu0 = load_emulator('Pb-Pb-2760', 0)
+        emu1 = load_emulator('Pb-Pb-2760', 1)
+        emu3 = load_emulator('Pb-Pb-2760', 3)
 
         map_params0 = np.array( MAP_params[system]['Grad'] )
         map_params1 = np.array( MAP_params[system]['C.E.'] )
@@ -3890,9 +3871,9 @@ def observables_sobol_sensitivity():
     design, design_min, design_max, design_labels = load_design(system)
 
     #load the emulator(s)
-    emu0 = dill.load(open('emulator/emulator-' + 'Pb-Pb-2760' + '-idf-0.dill', "rb"))
-    emu1 = dill.load(open('emulator/emulator-' + 'Pb-Pb-2760' + '-idf-1.dill', "rb"))
-    emu3 = dill.load(open('emulator/emulator-' + 'Pb-Pb-2760' + '-idf-3.dill', "rb"))
+    emu0 = load_emulator('Pb-Pb-2760', 0)
+    emu1 = load_emulator('Pb-Pb-2760', 1)
+    emu3 = load_emulator('Pb-Pb-2760', 3)
 
     choose_central_bin = True
     if choose_central_bin:
@@ -4320,7 +4301,7 @@ def pca_vectors_variance(system='PbPb2760'):
         ncols=2, gridspec_kw=dict(width_ratios=[5, 1])
     )
 
-    emu = Trained_Emulators[system]
+    emu = load_emulator(system, compact=False)
     pca = emu.pca
 
     ax = axes[0]
@@ -4434,7 +4415,7 @@ def diag_pca(system=system_strs[0]):
     Check for linear independence!
 
     """
-    Y = [g.y_train_ for g in Trained_Emulators[system].gps]
+    Y = [g.y_train_ for g in load_emulator(system, compact=False).gps]
     n = len(Y)
     ymax = np.ceil(max(np.fabs(y).max() for y in Y))
     lim = (-ymax, ymax)
@@ -4465,7 +4446,7 @@ def diag_emu(system=system_strs[0], pcs=None, label_all=True):
     overlaid by emulator predictions at several points in design space.
 
     """
-    gps = Trained_Emulators[system].gps
+    gps = load_emulator(system, compact=False).gps
     pcs = (
         range(len(gps)) if pcs is None else
         [p if p >= 0 else (len(gps) + p) for p in pcs]
@@ -11,15 +11,20 @@ from emulator import Trained_Emulators, Trained_Emulators_all_df, _Covariance
 from bayes_exp import Y_exp_data
 from bayes_mcmc import *
 
-MAP_params_combined = {}
+def MAP_params_combined(chain, label):
+    """
+    The MAP parameters in the order of the chain parameters (the
+    normalization of each system followed by the common parameters),
+    from the MAP_params of each system in configurations.py.
+    """
+    X = np.empty(chain.ndim - 1)
+    for s in system_strs:
+        X[chain.sys_idx[s]] = MAP_params[s][label]
+    return X
 
 #NOTE that if the MAP lies at exactly the boundary value, the log_likelihood will evaluate to zero because of the prior bounds,
-#in this case we need to add a small epsilon to put the value inside of the prior bounds
+#in this case we need to move it inside of the prior bounds by a small epsilon
 eps = 1.0e-5
-#                                N1      N2    p   sigma_k   w     d3   tau_R  alpha  T_eta,kink a_low   a_high eta_kink zeta_max T_(zeta,peak) w_zeta lambda_zeta    b_pi   T_s
-MAP_params_combined['Grad']  = [14.2,  5.73,  0.06,  1.05,  1.12,  3.00,  1.46,  0.031,  0.223,  -0.78,   0.37,    0.096,   0.13,      0.12+eps,      0.072,    -0.12,   4.65 , 0.136]
-MAP_params_combined['C.E.']  = [15.6,  6.24,  0.06,  1.00,  1.19,  2.60,  1.04,  0.024,  0.268,  -0.73,   0.38,    0.042,   0.127,     0.12+eps,      0.025+eps,    0.095,   5.6,  0.146]
-MAP_params_combined['P.B.']  = [13.2,  5.31,  0.14,  0.98,  0.81,  3.11,  1.46,  0.017,  0.194,  -0.47,   1.62,    0.105,   0.165,     0.194,      0.026,   -0.072,  5.54,  0.147]
 
 def calc_max_log_likelihood():
     #get the emulator predictions at the MAP values
@@ -29,7 +34,8 @@ def calc_max_log_likelihood():
     print("Calculating Log Likelihood at max. (at MAP values) for...")
     print("idf = " + str(idf))
     print(idf_label[idf])
-    X = np.array( MAP_params_combined[ idf_label_short[idf] ] + [1.1e-3]   )
+    X = np.append( MAP_params_combined(chain, idf_label_short[idf]), 1.1e-3 )
+    X = np.clip(X, chain.min + eps*(chain.max - chain.min), chain.max - eps*(chain.max - chain.min))
     log_l = chain.log_likelihood(X)
     print("log_likelihood = " + str(log_l))
     print("*********************************************************")
@@ -42,16 +48,25 @@ def calc_avg_log_likelihood():
     print("Calculating Avg. Log Likelihood for...")
     print("idf = " + str(idf))
     print(idf_label[idf])
-    #X = np.array( MAP_params_combined[ idf_label_short[idf] ] + [1.1e-3]   )
-    data = chain.load()
+    #use the log likelihood stored by the sampler if available,
+    #otherwise evaluate it on the chain
+    with chain.open() as f:
+        stored = 'log_likelihood' in f
+    if stored:
+        data = chain.load_log_likelihood()
+        data = data[np.isfinite(data)]
+        print("max. log_likelihood in chain = " + str(data.max()))
+    if not stored or data.size == 0:
+        stored = False
+        data = chain.load()
     thin = 10000
 
     avg_log_l_vals = []
     for iter in range(10):
         np.random.shuffle(data)
-        X = data[::thin, :]
+        X = data[::thin]
         start = time.time()
-        log_l = chain.log_likelihood(X)
+        log_l = X if stored else chain.log_likelihood(X)
         avg_log_l = log_l.mean()
         avg_log_l_vals.append(avg_log_l)
         end = time.time()
@@ -1,5 +1,10 @@
 #!/usr/bin/env python3
 
+import argparse
+from collections import namedtuple
+import hashlib
+import json
+from multiprocessing import Pool
 import numpy as np
 #import h5py
 import sys, os, glob
@@ -47,178 +52,251 @@ def mean_std(x):
         std = np.std(x, axis=0)/np.sqrt(Neff - 1. + 1e-9)
         return mean, std
 
-def calculate_dNdeta(ds, exp, cen, idf):
-        Ne = len(ds)
+# Centrality binning engine
+#
+# The events are ordered by decreasing dNch/deta and a centrality bin
+# [cl, ch] % holds the events cl/100*Ne to ch/100*Ne of that ordering.  The
+# bins may overlap, so the events of all bins are gathered once into one flat
+# array with contiguous segments, one per bin, and every per-bin sum is a
+# np.add.reduceat over those segments.
+
+Segments = namedtuple('Segments', ['take', 'seg', 'starts', 'counts'])
+
+def centrality_order(ds, exp, idf):
+        """
+        Event indices of `ds` in order of decreasing dNch/deta for delta-f `idf`.
+        """
+        return np.argsort(-ds[exp]['dNch_deta'][:, idf], kind='stable')
+
+def centrality_segments(cen, order, min_one=False):
+        """
+        Gather the events of the centrality bins `cen` (shape (nbins, 2), in %),
+        given the centrality `order` of the events.  If `min_one`, each bin
+        holds at least one event.
+
+        Returns Segments with `take` the event indices of all bins, concatenated,
+        `seg` the bin of each gathered event, and `starts`, `counts` the offset
+        and number of events of each bin in the gathered array.
+        """
+        index = (np.asarray(cen)/100.*len(order)).astype(int)
+        nl, nh = index[:, 0], index[:, 1]
+        if min_one:
+                nh = np.maximum(nh, nl+1)
+        counts = np.maximum(nh - nl, 0)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        seg = np.repeat(np.arange(len(counts)), counts)
+        take = order[nl[seg] + np.arange(seg.size) - starts[seg]]
+        return Segments(take, seg, starts, counts)
+
+def segment_sum(x, sg):
+        """
+        Sum the gathered array `x` over the events of each bin of `sg`, along
+        the first axis.  Empty bins sum to zero.
+        """
+        x = np.asarray(x)
+        out = np.zeros((len(sg.counts),) + x.shape[1:], dtype=x.dtype)
+        full = sg.counts > 0
+        if full.any():
+                out[full] = np.add.reduceat(x, sg.starts[full], axis=0)
+        return out
+
+def segment_mean_std(x, sg, w=None):
+        """
+        weighted_mean_std of the gathered array `x` (and weights `w`) in each
+        bin of `sg`, along the first axis, with a two-pass variance.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+                if w is None:
+                        Neff = sg.counts.reshape((-1,) + (1,)*(x.ndim-1)).astype(float)
+                        mean = segment_sum(x, sg)/Neff
+                        var = segment_sum((x - mean[sg.seg])**2, sg)/Neff
+                else:
+                        w = np.broadcast_to(w, x.shape)
+                        sum_w = segment_sum(w, sg)
+                        Neff = sum_w**2/segment_sum(w**2, sg)
+                        mean = segment_sum(w*x, sg)/sum_w
+                        var = segment_sum(w*(x - mean[sg.seg])**2, sg)/sum_w
+                std = ( var/(Neff-1.+1e-9) ) **.5
+        return mean, std
+
+def calculate_dNdeta(ds, exp, cen, idf, order=None):
+        if order is None:
+                order = np.arange(len(ds))
         cenM = np.mean(cen, axis=1)
-        index = (cen/100.*Ne).astype(int)
-        obs = np.zeros_like(cenM)
-        obs_err = np.zeros_like(cenM)
-        for i, (nl, nh) in enumerate(zip(index[:,0], index[:,1])):
-                nh = np.max([nh, nl+1])
-                obs[i], obs_err[i] = weighted_mean_std( ds[exp]['dNch_deta'][nl:nh, idf] )
+        sg = centrality_segments(cen, order, min_one=True)
+        obs, obs_err = segment_mean_std(ds[exp]['dNch_deta'][sg.take, idf], sg)
         return {'Name': 'dNch_deta', 'cenM': cenM, 'pTM' : None,
                         'obs': obs, 'err': obs_err}
 
 
-def calculate_dETdeta(ds, exp, cen, idf):
-        Ne = len(ds)
+def calculate_dETdeta(ds, exp, cen, idf, order=None):
+        if order is None:
+                order = np.arange(len(ds))
         cenM = np.mean(cen, axis=1)
-        index = (cen/100.*Ne).astype(int)
-        obs = np.zeros_like(cenM)
-        obs_err = np.zeros_like(cenM)
-        for i, (nl, nh) in enumerate(zip(index[:,0], index[:,1])):
-                obs[i], obs_err[i] = weighted_mean_std(ds[exp]['dET_deta'][nl:nh, idf])
+        sg = centrality_segments(cen, order)
+        obs, obs_err = segment_mean_std(ds[exp]['dET_deta'][sg.take, idf], sg)
         return {'Name': 'dNch_deta', 'cenM': cenM, 'pTM' : None,
                         'obs': obs, 'err': obs_err}
 
-def calculate_dNdy(ds, exp, cen, idf):
-        Ne = len(ds)
+def calculate_dNdy(ds, exp, cen, idf, order=None):
+        if order is None:
+                order = np.arange(len(ds))
         cenM = np.mean(cen, axis=1)
-        index = (cen/100.*Ne).astype(int)
-        obs = {s: np.zeros_like(cenM) for (s, _) in species}
-        obs_err = {s: np.zeros_like(cenM) for (s, _) in species}
-        for (s, _) in species:
-                for i, (nl, nh) in enumerate(zip(index[:,0], index[:,1])):
-                        obs[s][i], obs_err[s][i] = weighted_mean_std(ds[exp]['dN_dy'][s][nl:nh, idf])
+        sg = centrality_segments(cen, order)
+        dN_dy = ds[exp]['dN_dy'][sg.take, idf]
+        # all species at once, shape (nevents, nspecies)
+        x = np.column_stack([dN_dy[s] for (s, _) in species])
+        mean, std = segment_mean_std(x, sg)
+        obs = {s: mean[:, k] for k, (s, _) in enumerate(species)}
+        obs_err = {s: std[:, k] for k, (s, _) in enumerate(species)}
         return {'Name': 'dNch_deta', 'cenM': cenM, 'pTM' : None,
                         'obs': obs, 'err': obs_err}
 
-def calculate_dNdpT(ds, exp, cen, idf, s):
-        Ne = len(ds)
+def calculate_dNdpT(ds, exp, cen, idf, s, order=None):
+        if order is None:
+                order = np.arange(len(ds))
         cenM = np.mean(cen, axis=1)
-        index = (cen/100.*Ne).astype(int)
-        obs = np.zeros( (len(cenM), Qn_diff_NpT) )
-        obs_err = np.zeros( (len(cenM), Qn_diff_NpT) )
+        sg = centrality_segments(cen, order)
 
-        for i, (nl, nh) in enumerate(zip(index[:,0], index[:,1])):
-            #we need to manually normalize the number of particles by the number of oversamples
-            nos = ds[exp]['nsamples'][nl:nh, idf]
+        #we need to manually normalize the number of particles by the number of oversamples
+        nos = ds[exp]['nsamples'][sg.take, idf]
 
-            #normalize by the number of oversamples
-            dN_dpT = np.divide(  ds['d_flow_pid'][s]['N'][nl:nh, idf].T, nos ).T
-            obs[i,:], obs_err[i,:] = mean_std(dN_dpT)
+        #normalize by the number of oversamples
+        dN_dpT = np.divide(  ds['d_flow_pid'][s]['N'][sg.take, idf].T, nos ).T
+        obs, obs_err = segment_mean_std(dN_dpT, sg)
 
         return {'Name': 'dN_dpT', 'cenM': cenM, 'pTM' : None,
                         'obs': obs, 'err': obs_err}
 
-def calculate_mean_pT(ds, exp, cen, idf):
-        Ne = len(ds)
+def calculate_mean_pT(ds, exp, cen, idf, order=None):
+        if order is None:
+                order = np.arange(len(ds))
         cenM = np.mean(cen, axis=1)
-        index = (cen/100.*Ne).astype(int)
-        obs = {s: np.zeros_like(cenM) for (s, _) in species}
-        obs_err = {s: np.zeros_like(cenM) for (s, _) in species}
-        for (s, _) in species:
-                for i, (nl, nh) in enumerate(zip(index[:,0], index[:,1])):
-                        #old procedure doesn't make sense for particles with less than yield one per event
-                        #obs[s][i], obs_err[s][i] = weighted_mean_std(ds[exp]['mean_pT'][s][nl:nh, idf])
-                        #new procedure only averages over pT of particles found 
-                        obs[s][i], obs_err[s][i] = weighted_mean_std_exclude_zeros(ds[exp]['mean_pT'][s][nl:nh, idf])
+        sg = centrality_segments(cen, order)
+        mean_pT = ds[exp]['mean_pT'][sg.take, idf]
+        x = np.column_stack([mean_pT[s] for (s, _) in species])
+        #old procedure doesn't make sense for particles with less than yield one per event
+        #new procedure only averages over pT of particles found,
+        #i.e. events with zero mean pT get zero weight
+        mean, std = segment_mean_std(x, sg, w=(x != 0.).astype(float))
+        obs = {s: mean[:, k] for k, (s, _) in enumerate(species)}
+        obs_err = {s: std[:, k] for k, (s, _) in enumerate(species)}
         return {'Name': 'dNch_deta', 'cenM': cenM, 'pTM' : None,
                         'obs': obs, 'err': obs_err}
 
-def calculate_mean_pT_fluct(ds, exp, cen, idf):
-
-        Ne = len(ds)
+def calculate_mean_pT_fluct(ds, exp, cen, idf, order=None):
+        if order is None:
+                order = np.arange(len(ds))
         cenM = np.mean(cen, axis=1)
-        index = (cen/100.*Ne).astype(int)
-        obs = np.zeros_like(cenM)
-        obs_err = np.zeros_like(cenM)
-        for (s, _) in species:
-
-                for i, (nl, nh) in enumerate(zip(index[:,0], index[:,1])):
-                        N = ds[exp]['pT_fluct_chg']['N'][nl:nh, idf]
-                        sum_pT = ds[exp]['pT_fluct_chg']['sum_pT'][nl:nh, idf]
-                        sum_pTsq = ds[exp]['pT_fluct_chg']['sum_pT2'][nl:nh, idf]
-
-
-                        Npairs = .5*N*(N - 1)
-
-                        if ( sum_pT.sum() > 0. ):
-                            M = sum_pT.sum() / N.sum()
-                            # This is equivalent to the sum over pairs in Eq. (2).  It may be derived
-                            # by using that, in general,
-                            #
-                            #   \sum_{i,j>i} a_i a_j = 1/2 [(\sum_{i} a_i)^2 - \sum_{i} a_i^2].
-                            #
-                            # That is, the sum over pairs (a_i, a_j) may be re-expressed in terms of
-                            # the sum of a_i and sum of squares a_i^2.  Applying this to Eq. (2) and
-                            # collecting terms yields the following expression.
-                            x = (.5*(sum_pT**2 - sum_pTsq) - M*(N - 1)*sum_pT + M**2*Npairs)/Npairs
-                            meanC, stdC = weighted_mean_std(x, Npairs)
-                            obs[i] = np.sqrt(meanC)/M
-                            obs_err[i] = stdC*.5/np.sqrt(meanC)/M
-                        else :
-                            obs[i] = 0.
-                            obs_err[i] = 0.
+        sg = centrality_segments(cen, order)
+
+        N = ds[exp]['pT_fluct_chg']['N'][sg.take, idf]
+        sum_pT = ds[exp]['pT_fluct_chg']['sum_pT'][sg.take, idf]
+        sum_pTsq = ds[exp]['pT_fluct_chg']['sum_pT2'][sg.take, idf]
+
+        Npairs = .5*N*(N - 1)
+
+        # mean pT of each bin
+        tot_pT = segment_sum(sum_pT, sg)
+        found = tot_pT > 0.
+        with np.errstate(divide='ignore', invalid='ignore'):
+                M = np.where(found, tot_pT/segment_sum(N, sg), 1.)
+        Me = M[sg.seg]
+        # This is equivalent to the sum over pairs in Eq. (2).  It may be derived
+        # by using that, in general,
+        #
+        #   \sum_{i,j>i} a_i a_j = 1/2 [(\sum_{i} a_i)^2 - \sum_{i} a_i^2].
+        #
+        # That is, the sum over pairs (a_i, a_j) may be re-expressed in terms of
+        # the sum of a_i and sum of squares a_i^2.  Applying this to Eq. (2) and
+        # collecting terms yields the following expression.  Events with
+        # fewer than two particles have no pairs and zero weight.
+        with np.errstate(divide='ignore', invalid='ignore'):
+                x = np.where(Npairs > 0.,
+                        (.5*(sum_pT**2 - sum_pTsq) - Me*(N - 1)*sum_pT + Me**2*Npairs)/Npairs,
+                        0.)
+        meanC, stdC = segment_mean_std(x, sg, Npairs)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+                obs = np.where(found, np.sqrt(meanC)/M, 0.)
+                obs_err = np.where(found, stdC*.5/np.sqrt(meanC)/M, 0.)
 
         return {'Name': 'dNch_deta', 'cenM': cenM, 'pTM' : None,
                         'obs': obs, 'err': obs_err}
 
 
-def calculate_vn(ds, exp, cen, idf):
-        @list2array
-        def obs_and_err(qn, m):
-                w = m*(m-1.) # is this P_{M,2} in notation of Jonah's Thesis
-                if w.sum() == 0.:
-                    return 0., 0.
-                cn2 = (np.abs(qn)**2 - m)/w # is this is <2> in Jonah's thesis (p.27)
-                avg_cn2, std_avg_cn2 = weighted_mean_std(cn2, w)
-                if avg_cn2 < 0. :
-                    vn = -np.sqrt(-avg_cn2)
-                else :
-                    vn = np.sqrt(avg_cn2)
+def vn_obs_and_err(avg_cn2, std_avg_cn2):
+        """
+        vn{2} and its error from the averaged two-particle cumulant <2>,
+        with the sign of <2>.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+                vn = np.sign(avg_cn2)*np.sqrt(np.abs(avg_cn2))
                 vn_err = std_avg_cn2/2./vn
-                return vn, vn_err
-        Ne = len(ds)
-        cenM = np.mean(cen, axis=1)
-        index = (cen/100.*Ne).astype(int)
-
-        obs = np.zeros([len(cenM), Nharmonic])
-        obs_err = np.zeros([len(cenM), Nharmonic])
+        return vn, vn_err
 
-        for i, (nl, nh) in enumerate(zip(index[:,0], index[:,1])):
-                M = ds[exp]['flow']['N'][nl:nh, idf]
-                for n in range(Nharmonic):
-                        Q = ds[exp]['flow']['Qn'][nl:nh, idf, n]
-                        obs[i,n], obs_err[i,n] = obs_and_err(Q, M)
+def calculate_vn(ds, exp, cen, idf, order=None):
+        if order is None:
+                order = np.arange(len(ds))
+        cenM = np.mean(cen, axis=1)
+        sg = centrality_segments(cen, order)
+
+        M = ds[exp]['flow']['N'][sg.take, idf].astype(float)
+        Q = ds[exp]['flow']['Qn'][sg.take, idf]
+
+        # all harmonics at once, shape (nevents, Nharmonic)
+        w = np.broadcast_to((M*(M-1.))[:, np.newaxis], Q.shape) # is this P_{M,2} in notation of Jonah's Thesis
+        with np.errstate(divide='ignore', invalid='ignore'):
+                cn2 = np.where(w > 0., (np.abs(Q)**2 - M[:, np.newaxis])/w, 0.) # is this is <2> in Jonah's thesis (p.27)
+        avg_cn2, std_avg_cn2 = segment_mean_std(cn2, sg, w)
+        obs, obs_err = vn_obs_and_err(avg_cn2, std_avg_cn2)
+
+        # bins without pairs
+        empty = segment_sum(w, sg) == 0.
+        obs[empty] = 0.
+        obs_err[empty] = 0.
         return {'Name': 'vn', 'cenM': cenM, 'pTM' : None,
                         'obs': obs, 'err': obs_err}
 
-def calculate_diff_vn(ds, exp, cenbins, pTbins, idf, pid='chg'):
-        Ne = len(ds)
+def calculate_diff_vn(ds, exp, cenbins, pTbins, idf, pid='chg', order=None):
+        if order is None:
+                order = np.arange(len(ds))
         pTbins = np.array(pTbins)
         cenbins = np.array(cenbins)
         cenM = np.mean(cenbins, axis=1)
         pTM = np.mean(pTbins, axis=1)
-        Cindex = (cenbins/100.*Ne).astype(int)
+        sg = centrality_segments(cenbins, order)
 
         obs = 'd_flow_pid'
-        data = ds[obs][:,idf][pid]
+        data = ds[obs][pid][sg.take, idf]
 
         # need soft flow within the same centrality bin first
         # only needs Ncen x [v2, v3]
-        vnref = calculate_vn(ds, exp, cenbins, idf)
-
-        # calculate hard vn
-        vn = np.zeros([len(cenM), len(pTM), Nharmonic_diff])
-        vn_err = np.zeros([len(cenM), len(pTM), Nharmonic_diff])
-        for i, (nl, nh) in enumerate(Cindex):
-                for j, (pl, ph) in enumerate(pTbins):
-                        for n in range(Nharmonic_diff):
-                                #w = data['N'][nl:nh, j] * ds[exp]['flow']['N'][nl:nh, idf]
-                                w = (data['N'][nl:nh, j]).astype(float) * (ds[exp]['flow']['N'][nl:nh, idf]).astype(float) + 1e-9
-                                dn2 = (data['Qn'][nl:nh,j,n].conjugate() * ds[exp]['flow']['Qn'][nl:nh, idf, n]).real / w
-                                avg_dn2, std_avg_dn2 = weighted_mean_std(dn2, w)
-                                vn[i, j, n] = avg_dn2/vnref['obs'][i,n]
-                                vn_err[i, j, n] = std_avg_dn2/vnref['obs'][i,n]
+        vnref = calculate_vn(ds, exp, cenbins, idf, order=order)
+
+        # calculate hard vn for all pT bins and harmonics at once,
+        # shape (nevents, NpT, Nharmonic_diff)
+        NpT = len(pTM)
+        Nref = ds[exp]['flow']['N'][sg.take, idf].astype(float)
+        Qref = ds[exp]['flow']['Qn'][sg.take, idf, np.newaxis, :Nharmonic_diff]
+        w = data['N'][:, :NpT].astype(float) * Nref[:, np.newaxis] + 1e-9
+        w = np.broadcast_to(w[:, :, np.newaxis], (len(sg.take), NpT, Nharmonic_diff))
+        dn2 = (data['Qn'][:, :NpT, :Nharmonic_diff].conjugate() * Qref).real / w
+        avg_dn2, std_avg_dn2 = segment_mean_std(dn2, sg, w)
+
+        ref = vnref['obs'][:, np.newaxis, :Nharmonic_diff]
+        with np.errstate(divide='ignore', invalid='ignore'):
+                vn = avg_dn2/ref
+                vn_err = std_avg_dn2/ref
         return {'Name': 'vn2', 'cenM': cenM, 'pTM' : pTM,
                         'obs': vn, 'err': vn_err}
 
-def load_and_compute(inputfile, system, specify_idf=None):
+def load_and_compute(inputfile, system, specify_idf=None, save_predictions=True):
 
     expt_type = expt_for_system[system]
     entry = np.zeros(1, dtype=np.dtype(bayes_dtype))
-    res_unsort = np.fromfile(inputfile, dtype=return_result_dtype(expt_type))
+    # memory-mapped, the calculate_* functions only read the fields they use
+    res_unsort = open_events(inputfile, expt_type)
 
     if specify_idf == None:
         idf_arr = [0, 1, 2, 3]
@@ -227,15 +305,26 @@ def load_and_compute(inputfile, system, specify_idf=None):
     for idf in idf_arr:
         print("----------------------")
         print("idf : " + str(idf) )
-        res = np.array(sorted(res_unsort, key=lambda x: x[expt_type][idf]['dNch_deta'], reverse=True))
+        # the events are not reordered, the centrality bins index into them
+        res = res_unsort
+        order = centrality_order(res, expt_type, idf)
         print("Result size : " + str(res.size))
         print("Number events w/o charged particles : " + str( (res_unsort[expt_type]['dNch_deta'][:, idf] == 0).sum() ) )
 
+        # each calculate_* function computes all species / harmonics of a
+        # centrality binning at once, so compute each binning only once
+        computed = {}
+        def compute(func, cenb):
+            key = (func.__name__, cenb.tobytes())
+            if key not in computed:
+                computed[key] = func(res, expt_type, cenb, idf, order=order)
+            return computed[key]
+
         # dNdeta
         tmp_obs='dNch_deta'
         try :
             cenb=np.array(obs_cent_list[system][tmp_obs])
-            info = calculate_dNdeta(res, expt_type, cenb, idf)
+            info = compute(calculate_dNdeta, cenb)
             entry[system][tmp_obs]['mean'][:, idf] = info['obs']
             entry[system][tmp_obs]['err'][:,idf] = info['err']
         except KeyError :
@@ -246,7 +335,7 @@ def load_and_compute(inputfile, system, specify_idf=None):
         tmp_obs='dET_deta'
         try :
             cenb=np.array(obs_cent_list[system][tmp_obs])
-            info = calculate_dETdeta(res, expt_type, cenb, idf)
+            info = compute(calculate_dETdeta, cenb)
             entry[system][tmp_obs]['mean'][:,idf] = info['obs']
             entry[system][tmp_obs]['err'][:,idf] = info['err']
         except KeyError :
@@ -257,7 +346,7 @@ def load_and_compute(inputfile, system, specify_idf=None):
         for s in ['pion', 'kaon', 'proton', 'Lambda', 'Omega', 'Xi', 'd']:
             try :
                 cenb=np.array(obs_cent_list[system]['dN_dy_'+s])
-                info = calculate_dNdy(res, expt_type, cenb, idf)
+                info = compute(calculate_dNdy, cenb)
                 entry[system]['dN_dy_'+s]['mean'][:,idf] = info['obs'][s]
                 entry[system]['dN_dy_'+s]['err'][:,idf] = info['err'][s]
             except KeyError :
@@ -268,7 +357,7 @@ def load_and_compute(inputfile, system, specify_idf=None):
         for s in ['pion','kaon','proton', 'd']:
             try :
                 cenb=np.array(obs_cent_list[system]['mean_pT_'+s])
-                info = calculate_mean_pT(res, expt_type, cenb, idf)
+                info = compute(calculate_mean_pT, cenb)
                 entry[system]['mean_pT_'+s]['mean'][:,idf] = info['obs'][s]
                 entry[system]['mean_pT_'+s]['err'][:,idf] = info['err'][s]
             except KeyError:
@@ -278,7 +367,7 @@ def load_and_compute(inputfile, system, specify_idf=None):
         tmp_obs='pT_fluct'
         try :
             cenb=np.array(obs_cent_list[system][tmp_obs])
-            info = calculate_mean_pT_fluct(res, expt_type, cenb, idf)
+            info = compute(calculate_mean_pT_fluct, cenb)
             entry[system][tmp_obs]['mean'][:,idf] = info['obs']
             entry[system][tmp_obs]['err'][:,idf] = info['err']
         except KeyError :
@@ -289,7 +378,7 @@ def load_and_compute(inputfile, system, specify_idf=None):
             tmp_obs='v'+str(n)+'2'
             try :
                 cenb=np.array(obs_cent_list[system][tmp_obs])
-                info = calculate_vn(res, expt_type, cenb, idf)
+                info = compute(calculate_vn, cenb)
                 entry[system][tmp_obs]['mean'][:,idf] = info['obs'][:, n-1]
                 entry[system][tmp_obs]['err'][:,idf] = info['err'][:, n-1]
             except KeyError :
@@ -311,66 +400,263 @@ def load_and_compute(inputfile, system, specify_idf=None):
                     pass
         """
 
-        from bins_and_cuts import ALICE_cent_bins
+        # the pT differential predictions are written to the MAP directory
+        if save_predictions:
+            from bins_and_cuts import ALICE_cent_bins
 
-        # pT differential vn
-        cenb = ALICE_cent_bins
-        from calculations_file_format_single_event import Qn_diff_pT_cuts
-        pTbins = []
-        for i in range( len(Qn_diff_pT_cuts) - 1 ):
-            pTbins.append( [Qn_diff_pT_cuts[i],  Qn_diff_pT_cuts[i+1]] )
+            # pT differential vn
+            cenb = ALICE_cent_bins
+            from calculations_file_format_single_event import Qn_diff_pT_cuts
+            pTbins = []
+            for i in range( len(Qn_diff_pT_cuts) - 1 ):
+                pTbins.append( [Qn_diff_pT_cuts[i],  Qn_diff_pT_cuts[i+1]] )
 
-        dir_str = 'model_calculations/MAP/' + idf_label_short[idf] + '/Predictions/diff_vn/'
-        np.savetxt(dir_str + 'pT_bin_edges', Qn_diff_pT_cuts)
+            dir_str = 'model_calculations/MAP/' + idf_label_short[idf] + '/Predictions/diff_vn/'
+            np.savetxt(dir_str + 'pT_bin_edges', Qn_diff_pT_cuts)
 
-        for n in range(Nharmonic_diff):
             for name, pid in Qn_species:
-                info = calculate_diff_vn(res, expt_type, cenb, pTbins, idf, pid=name)
-                for icent, cent in enumerate(cenb):
-                    cent_dir_str = str(cent[0]) + '-' + str(cent[1])
-                    loc_dir_str = dir_str + cent_dir_str
-                    file_str = loc_dir_str + '/' + name + '_v' + str(n+1)
-                    obs_and_err = np.column_stack( (info['obs'][icent, :, n], info['err'][icent, :, n]) )
-                    np.savetxt(file_str, obs_and_err)
+                info = calculate_diff_vn(res, expt_type, cenb, pTbins, idf, pid=name, order=order)
+                for n in range(Nharmonic_diff):
+                    for icent, cent in enumerate(cenb):
+                        cent_dir_str = str(cent[0]) + '-' + str(cent[1])
+                        loc_dir_str = dir_str + cent_dir_str
+                        file_str = loc_dir_str + '/' + name + '_v' + str(n+1)
+                        obs_and_err = np.column_stack( (info['obs'][icent, :, n], info['err'][icent, :, n]) )
+                        np.savetxt(file_str, obs_and_err)
+
+
+            #pid dN/dpT
+            for s,_ in Qn_species:
+                cenb = ALICE_cent_bins
+                info = calculate_dNdpT(res, expt_type, cenb, idf, s, order=order)
+
+                # instead of saving dN/dpT to entry (changing bayes_dtype) ...
+                # save it to its own file
+                #file_str = 'diff_pT_spectra/idf_' + str(idf) + '/dN_dpT_' + s
+                dir_str = 'model_calculations/MAP/' + idf_label_short[idf] + '/Predictions/diff_pT_spectra/'
+                file_str = dir_str + 'dN_dpT_' + s
+                np.savetxt(file_str, info['obs'])
+                #save the pT bins to file
+                np.savetxt(dir_str + 'pT_bin_edges', Qn_diff_pT_cuts)
 
 
-        #pid dN/dpT
-        for s,_ in Qn_species:
-            cenb = ALICE_cent_bins
-            info = calculate_dNdpT(res, expt_type, cenb, idf, s)
-
-            # instead of saving dN/dpT to entry (changing bayes_dtype) ...
-            # save it to its own file
-            #file_str = 'diff_pT_spectra/idf_' + str(idf) + '/dN_dpT_' + s
-            dir_str = 'model_calculations/MAP/' + idf_label_short[idf] + '/Predictions/diff_pT_spectra/'
-            file_str = dir_str + 'dN_dpT_' + s
-            np.savetxt(file_str, info['obs'])
-            #save the pT bins to file
-            np.savetxt(dir_str + 'pT_bin_edges', Qn_diff_pT_cuts)
+    return entry
 
+# Manifest of the averaged event files
+#
+# Next to each output file <name>.dat, <name>_manifest.json records for every
+# averaged design point the size, mtime, sha1 and number of events of its
+# event file, together with the event and output dtypes and centrality bins.
+# An incremental run recomputes only the points whose event file changed.
+
+def manifest_path(file_output):
+    return os.path.splitext(file_output)[0] + '_manifest.json'
+
+def manifest_signature(system):
+    """
+    Everything besides the event files that determines the averaged rows.
+    """
+    return {
+        'event_dtype' : str(np.dtype(return_result_dtype(expt_for_system[system]))),
+        'output_dtype' : str(np.dtype([bayes_dtype[system_strs.index(system)]])),
+        'obs_cent_list' : {
+            obs : np.array(cent_list).tolist()
+            for obs, cent_list in obs_cent_list[system].items()
+        },
+    }
+
+def file_sha1(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def event_file_info(filename, system, sha1=None):
+    """
+    Manifest entry of the event file `filename`.
+    """
+    st = os.stat(filename)
+    itemsize = np.dtype(return_result_dtype(expt_for_system[system])).itemsize
+    return {
+        'size' : st.st_size,
+        'mtime' : st.st_mtime_ns,
+        'sha1' : file_sha1(filename) if sha1 is None else sha1,
+        'n_events' : st.st_size // itemsize,
+    }
+
+def load_manifest(file_output):
+    try:
+        with open(manifest_path(file_output), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_manifest(file_output, manifest):
+    path = manifest_path(file_output)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+def changed_design_points(folder_input, nset, system, manifest):
+    """
+    Return a dict design point -> sha1 (or None if not hashed) of the event
+    files that are new or changed since `manifest`.  Files whose size or
+    mtime changed but not their contents only get their manifest entry
+    updated.
+    """
+    changed = {}
+    for i in range(nset):
+        filename = folder_input + "/{:d}.dat".format(i)
+        entry = manifest['points'].get(str(i))
+        try:
+            st = os.stat(filename)
+        except OSError:
+            changed[i] = None
+            continue
+        if entry is None:
+            changed[i] = None
+        elif (entry['size'], entry['mtime']) != (st.st_size, st.st_mtime_ns):
+            sha1 = file_sha1(filename)
+            if sha1 == entry['sha1']:
+                entry.update(event_file_info(filename, system, sha1))
+            else:
+                changed[i] = sha1
+    return changed
+
+# output memmap of the workers of average_design_points
+_output = None
+
+def _init_worker(file_output, nset, system):
+    global _output
+    _output = np.memmap(file_output, dtype=[bayes_dtype[system_strs.index(system)]], mode='r+', shape=(nset,))
+
+def average_point(job):
+    """
+    Average the events of one design point and write them into its row of
+    the output memmap.  Returns the design point, the error if any, and the
+    manifest entry of its event file.
+    """
+    pt, filename, system, sha1 = job
+    try:
+        info = event_file_info(filename, system, sha1)
+        entry = load_and_compute(filename, system, save_predictions=False)
+        _output[system][pt] = entry[system][0]
+        _output.flush()
+    except Exception as err:
+        return pt, repr(err), None
+    return pt, None, info
+
+def average_design_points(folder_input, file_output, nset, system, nprocs=1, incremental=False):
+    """
+    Average the events <folder_input>/<i>.dat of the `nset` design points of
+    `system` into `file_output`, over `nprocs` processes.
+
+    The output is pre-sized and each design point writes its own row, so the
+    points may finish in any order.  The rows of points that fail stay NaN.
+    If `incremental`, and the manifest of a previous run matches, only the
+    new or changed points are recomputed and their rows patched in place;
+    if `nset` changed, the output is resized and the new points averaged.
+    The manifest is written before any row is reset, so after a crash it
+    never lists a point whose row is not valid.
+    Returns the list of failed design points.
+    """
+    sdtype = [bayes_dtype[system_strs.index(system)]]
+    itemsize = np.dtype(sdtype).itemsize
+    if nset == 0:
+        np.zeros(0, dtype=sdtype).tofile(file_output)
+        return []
+
+    signature = manifest_signature(system)
+    manifest = load_manifest(file_output) if incremental else None
+    if (manifest is not None
+            and manifest.get('signature') == signature
+            and os.path.exists(file_output)
+            and os.path.getsize(file_output) % itemsize == 0):
+        manifest['points'] = {
+            pt : entry for pt, entry in manifest['points'].items() if int(pt) < nset
+        }
+        # points beyond the previous nset have no manifest entry, so they are changed
+        changed = changed_design_points(folder_input, nset, system, manifest)
+        print("{:d} of {:d} design pts changed".format(len(changed), nset))
+        for i in changed:
+            manifest['points'].pop(str(i), None)
+        write_manifest(file_output, manifest)
+        if os.path.getsize(file_output) != nset*itemsize:
+            print("resizing output to {:d} design pts".format(nset))
+            os.truncate(file_output, nset*itemsize)
+        output = np.memmap(file_output, dtype=sdtype, mode='r+', shape=(nset,))
+        for i in changed:
+            output[i:i+1].view(float_t)[:] = np.nan
+    else:
+        if incremental:
+            print("no matching manifest, averaging all design pts")
+        # remove the previous manifest before truncating the rows it describes
+        if os.path.exists(manifest_path(file_output)):
+            os.remove(manifest_path(file_output))
+        manifest = {'signature' : signature, 'points' : {}}
+        changed = dict.fromkeys(range(nset))
+        output = np.memmap(file_output, dtype=sdtype, mode='w+', shape=(nset,))
+        output.view(float_t)[:] = np.nan
+        write_manifest(file_output, manifest)
+    output.flush()
+    del output
+
+    jobs = [(i, folder_input + "/{:d}.dat".format(i), system, sha1) for i, sha1 in changed.items()]
+    failed = []
+    def report(pt, err, info):
+        if err is None:
+            print("finished design pt : " + str(pt))
+            manifest['points'][str(pt)] = info
+        else:
+            print("FAILED design pt : " + str(pt) + " : " + err)
+            failed.append(pt)
 
-    return entry
+    if nprocs > 1 and len(jobs) > 1:
+        with Pool(nprocs, initializer=_init_worker, initargs=(file_output, nset, system)) as pool:
+            for result in pool.imap_unordered(average_point, jobs):
+                report(*result)
+    else:
+        _init_worker(file_output, nset, system)
+        for job in jobs:
+            print("design pt : " + str(job[0]))
+            report(*average_point(job))
 
-if __name__ == '__main__':
+    write_manifest(file_output, manifest)
 
-    system = system_strs[0]
+    return sorted(failed)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='average the events of all design points')
+    parser.add_argument(
+        '--system', default=system_strs[0], choices=system_strs,
+        help='collision system (default: the first of system_strs)'
+    )
+    parser.add_argument(
+        '--nprocs', type=int, default=1,
+        help='number of design points averaged at once (default: 1)'
+    )
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help='only average the design points whose event files changed since the last run'
+    )
+    args = parser.parse_args()
+
+    system = args.system
 
     print("Computing observables for all design points")
     print("System = " + system)
     for folder_input, file_output, nset in zip(
-              [f_events_main, f_events_validation],
-              [f_obs_main, f_obs_validation],
-              [n_design_pts_main, n_design_pts_validation],
+              [SystemsInfo[system]['main_events_dir'], SystemsInfo[system]['validation_events_dir']],
+              [SystemsInfo[system]['main_obs_file'], SystemsInfo[system]['validation_obs_file']],
+              [SystemsInfo[system]['n_design'], SystemsInfo[system]['n_validation']],
            ):
         print("\n")
         print("Averaging events in " + folder_input)
         print("##########################")
-        results = []
-        for i in range(nset):
-            print("design pt : " + str(i))
-            filename = folder_input + "/{:d}.dat".format(i)
-            results.append(load_and_compute(filename, system)[0])
-            print("\n")
-        results = np.array(results)
-        print("results.shape = " + str(results.shape))
-        results.tofile(file_output)
+        os.makedirs(os.path.dirname(file_output), exist_ok=True)
+        failed = average_design_points(folder_input, file_output, nset, system,
+                                       nprocs=args.nprocs, incremental=args.incremental)
+        print("results written to " + file_output)
+        if failed:
+            print("WARNING : averaging failed for design pts " + str(failed))
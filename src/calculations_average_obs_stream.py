@@ -0,0 +1,442 @@
+#!/usr/bin/env python3
+"""
+Streaming event averaging: the centrality-bin averages of
+calculations_average_obs.py computed chunk by chunk, in constant memory.
+
+An event is in the centrality bin [cl, ch] % if lower < dNch/deta <= upper,
+with upper and lower the thresholds of the edges cl and ch, taken from a
+centrality table (dNch/deta at each centrality edge, for each delta-f).
+The table is either precomputed, e.g. from a large minimum bias sample, or
+computed from the events themselves in a first pass which only reads
+dNch/deta.  Events tied at a threshold all fall into the more central bin,
+whereas calculations_average_obs.py splits them between the two bins by
+rank, so the averages only agree with it when no multiplicities tie at a bin
+edge.  A bin without events, e.g. one whose two thresholds are equal, gives
+NaN for all observables.
+
+For each bin the weighted sums of dNch/deta, dET/deta, dN/dy, <pT>, the
+pT fluctuation cumulant and the flow Q-vector correlators are accumulated
+with Welford-style updates.  The partial accumulators of separate runs, e.g.
+batch jobs of the same design point, can be saved and merged. ::
+
+    # average the events of design point 0 from two batches
+    ./src/calculations_average_obs_stream.py Events/main/0-a.dat Events/main/0-b.dat -o obs-0.dat
+
+    # or as the batches finish, then merge
+    ./src/calculations_average_obs_stream.py Events/main/0-a.dat --table table.dat --partial a.npz
+    ./src/calculations_average_obs_stream.py Events/main/0-b.dat --table table.dat --partial b.npz
+    ./src/calculations_average_obs_stream.py --merge a.npz b.npz -o obs-0.dat
+"""
+
+import argparse
+
+import numpy as np
+
+from calculations_file_format_single_event import *
+from configurations import *
+from calculations_average_obs import Segments, segment_sum, vn_obs_and_err
+
+# names of the identified particles in obs_cent_list
+dN_dy_species = ['pion', 'kaon', 'proton', 'Lambda', 'Omega', 'Xi', 'd']
+mean_pT_species = ['pion', 'kaon', 'proton', 'd']
+
+class BinnedMoments:
+    """
+    Mergeable weighted mean and variance accumulators for a set of bins.
+
+    For each bin it holds the sum of weights and of squared weights, the
+    weighted mean and the weighted sum of squared deviations from the mean,
+    with shape (nbins,) + the shape of the accumulated values.  Batches are
+    combined with the parallel update of Chan et al., so the order and
+    splitting of the events does not matter.
+    """
+    def __init__(self, nbins, shape=()):
+        shape = (nbins,) + tuple(shape)
+        self.sum_w = np.zeros(shape)
+        self.sum_w2 = np.zeros(shape)
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+
+    def add(self, x, sg, w=None):
+        """
+        Accumulate the values `x` (and weights `w`), gathered by the bins of
+        Segments `sg` (see centrality_segments).
+        """
+        x = np.asarray(x, dtype=float)
+        w = np.ones_like(x) if w is None else np.broadcast_to(w, x.shape)
+        batch = BinnedMoments(0)
+        batch.sum_w = segment_sum(w, sg)
+        batch.sum_w2 = segment_sum(w**2, sg)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            batch.mean = np.where(batch.sum_w > 0., segment_sum(w*x, sg)/batch.sum_w, 0.)
+        batch.m2 = segment_sum(w*(x - batch.mean[sg.seg])**2, sg)
+        return self.merge(batch)
+
+    def merge(self, other):
+        """
+        Add the accumulated sums of `other` to these.
+        """
+        sum_w = self.sum_w + other.sum_w
+        delta = other.mean - self.mean
+        with np.errstate(divide='ignore', invalid='ignore'):
+            f = np.where(sum_w > 0., other.sum_w/sum_w, 0.)
+        self.mean = self.mean + delta*f
+        self.m2 = self.m2 + other.m2 + delta**2*self.sum_w*f
+        self.sum_w = sum_w
+        self.sum_w2 = self.sum_w2 + other.sum_w2
+        return self
+
+    def mean_std(self):
+        """
+        Weighted mean and error of the mean of each bin, as weighted_mean_std.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            Neff = self.sum_w**2/self.sum_w2
+            std = ( self.m2/self.sum_w/(Neff-1.+1e-9) ) **.5
+            mean = np.where(self.sum_w > 0., self.mean, np.nan)
+        return mean, std
+
+def centrality_edges(system):
+    """
+    All centrality bin edges of the observables of `system`.
+    """
+    return np.unique(np.concatenate([
+        np.ravel(cent_list) for cent_list in obs_cent_list[system].values()
+    ]).astype(float))
+
+def centrality_table(dNch_deta, edges):
+    """
+    Centrality table of the events with multiplicities `dNch_deta` (shape
+    (nevents, ndf)): the dNch/deta threshold of each centrality edge (in %),
+    i.e. of the event at rank edge/100*nevents in order of decreasing
+    dNch/deta, as in calculations_average_obs.  Returns an array of shape
+    (nedges, 1 + ndf) whose first column are the edges.
+    """
+    nevents = len(dNch_deta)
+    desc = -np.sort(-dNch_deta, axis=0)
+    index = (np.asarray(edges)/100.*nevents).astype(int)
+    thresholds = np.full((len(edges), dNch_deta.shape[1]), -np.inf)
+    inside = index < nevents
+    thresholds[inside] = desc[index[inside]]
+    return np.column_stack((edges, thresholds))
+
+def read_centrality_table(filenames, expt_type, edges, chunk_size=1000):
+    """
+    First pass over the events: compute their centrality table, reading only
+    dNch/deta.
+    """
+    dNch_deta = np.concatenate([
+        np.array(chunk[expt_type]['dNch_deta'])
+        for chunk in event_chunks(filenames, expt_type, chunk_size)
+    ])
+    return centrality_table(dNch_deta, edges)
+
+def bin_thresholds(table, cen, idf):
+    """
+    The (upper, lower) dNch/deta thresholds of the centrality bins `cen` for
+    delta-f `idf` from the centrality `table`.
+    """
+    def lookup(edge):
+        row = np.isclose(table[:, 0], edge)
+        if not row.any():
+            raise ValueError('centrality edge {:g} % not in the centrality table'.format(edge))
+        return table[row, 1 + idf][0]
+    cen = np.asarray(cen, dtype=float)
+    upper = np.array([lookup(cl) for cl in cen[:, 0]])
+    lower = np.array([lookup(ch) for ch in cen[:, 1]])
+    return upper, lower
+
+def threshold_segments(x, upper, lower):
+    """
+    Segments (see calculations_average_obs.centrality_segments) of the
+    events with multiplicities `x` in the bins lower < x <= upper.  Events
+    tied at a threshold all go to the bin it is the upper threshold of.
+    """
+    inside = (x[:, np.newaxis] <= upper) & (x[:, np.newaxis] > lower)
+    seg, take = np.nonzero(inside.T)
+    counts = inside.sum(axis=0)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    return Segments(take, seg, starts, counts)
+
+class StreamingAverager:
+    """
+    Centrality-bin accumulators of all observables of `system` for all
+    delta-f, given the centrality `table` (see centrality_table).
+
+    Events are added chunk by chunk with `add`, partial averagers (with the
+    same table) are combined with `merge`, and `entry` returns the averages
+    as one row of bayes_dtype, as load_and_compute.
+    """
+    def __init__(self, system, table):
+        self.system = system
+        self.expt_type = expt_for_system[system]
+        self.table = np.array(table)
+        self.nevents = 0
+
+        # (delta-f, centrality bins) -> {observable kind : BinnedMoments}
+        self.acc = {}
+        self.bins = {}
+        for cent_list in obs_cent_list[system].values():
+            key = np.array(cent_list, dtype=float).tobytes()
+            self.bins[key] = np.array(cent_list, dtype=float)
+        nbins = {key: len(cen) for key, cen in self.bins.items()}
+        for idf in range(number_of_viscous_corrections):
+            for key in self.bins:
+                n = nbins[key]
+                self.acc[idf, key] = {
+                    'dNch_deta' : BinnedMoments(n),
+                    'dET_deta' : BinnedMoments(n),
+                    'dN_dy' : BinnedMoments(n, (len(species),)),
+                    'mean_pT' : BinnedMoments(n, (len(species),)),
+                    # total sum pT and N, and the per pair terms a, b, a + b
+                    # of the pT fluctuation cumulant (see add)
+                    'pT_sums' : BinnedMoments(n, (2,)),
+                    'pT_fluct' : BinnedMoments(n, (3,)),
+                    'vn' : BinnedMoments(n, (Nharmonic,)),
+                }
+
+    def add(self, events):
+        """
+        Accumulate a chunk of `events` (structured array of
+        return_result_dtype, e.g. from event_chunks).
+        """
+        ev = events[self.expt_type]
+        self.nevents += len(events)
+        for idf in range(number_of_viscous_corrections):
+            x = np.array(ev['dNch_deta'][:, idf])
+            for key, cen in self.bins.items():
+                sg = threshold_segments(x, *bin_thresholds(self.table, cen, idf))
+                if sg.take.size == 0:
+                    continue
+                acc = self.acc[idf, key]
+                e = ev[sg.take, idf]
+
+                acc['dNch_deta'].add(e['dNch_deta'], sg)
+                acc['dET_deta'].add(e['dET_deta'], sg)
+                acc['dN_dy'].add(np.column_stack([e['dN_dy'][s] for (s, _) in species]), sg)
+                mean_pT = np.column_stack([e['mean_pT'][s] for (s, _) in species])
+                acc['mean_pT'].add(mean_pT, sg, w=(mean_pT != 0.).astype(float))
+
+                # With M the mean pT of the bin, the per pair cumulant is
+                # x = a - M b + M^2 with a = 1/2 (sum_pT^2 - sum_pT2)/Npairs
+                # and b = (N - 1) sum_pT/Npairs, weighted by Npairs.  Its
+                # mean and variance follow from those of a, b and a + b,
+                # so M need not be known while accumulating.
+                N = e['pT_fluct_chg']['N'].astype(float)
+                sum_pT = e['pT_fluct_chg']['sum_pT']
+                sum_pTsq = e['pT_fluct_chg']['sum_pT2']
+                Npairs = .5*N*(N - 1)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    a = np.where(Npairs > 0., .5*(sum_pT**2 - sum_pTsq)/Npairs, 0.)
+                    b = np.where(Npairs > 0., (N - 1)*sum_pT/Npairs, 0.)
+                acc['pT_sums'].add(np.column_stack((sum_pT, N)), sg)
+                acc['pT_fluct'].add(np.column_stack((a, b, a + b)), sg, w=Npairs[:, np.newaxis])
+
+                M = e['flow']['N'].astype(float)
+                Q = e['flow']['Qn']
+                w = np.broadcast_to((M*(M-1.))[:, np.newaxis], Q.shape)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    cn2 = np.where(w > 0., (np.abs(Q)**2 - M[:, np.newaxis])/w, 0.)
+                acc['vn'].add(cn2, sg, w=w)
+        return self
+
+    def merge(self, other):
+        """
+        Add the accumulators of `other`, which must use the same table.
+        """
+        if not np.array_equal(self.table, other.table):
+            raise ValueError('cannot merge accumulators with different centrality tables')
+        for k, acc in self.acc.items():
+            for kind, moments in acc.items():
+                moments.merge(other.acc[k][kind])
+        self.nevents += other.nevents
+        return self
+
+    def save(self, filename):
+        """
+        Write the accumulators, the table and the number of events to
+        `filename` as numpy arrays (np.savez), to be read by `load`.
+        """
+        arrays = {
+            'system' : np.array(self.system),
+            'table' : self.table,
+            'nevents' : np.array(self.nevents),
+        }
+        for j, cen in enumerate(self.bins.values()):
+            arrays['bins_{:d}'.format(j)] = cen
+        for (idf, key), acc in self.acc.items():
+            j = list(self.bins).index(key)
+            for kind, moments in acc.items():
+                for field in ['sum_w', 'sum_w2', 'mean', 'm2']:
+                    name = 'acc_{:d}_{:d}_{:s}_{:s}'.format(idf, j, kind, field)
+                    arrays[name] = getattr(moments, field)
+        with open(filename, 'wb') as f:
+            np.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Read accumulators written by `save`.  The centrality bins of the
+        current configuration must be those they were accumulated for.
+        """
+        with np.load(filename, allow_pickle=False) as arrays:
+            averager = cls(str(arrays['system']), arrays['table'])
+            averager.nevents = int(arrays['nevents'])
+            nbins = sum(name.startswith('bins_') for name in arrays.files)
+            if (nbins != len(averager.bins) or not all(
+                    np.array_equal(cen, arrays['bins_{:d}'.format(j)])
+                    for j, cen in enumerate(averager.bins.values()))):
+                raise ValueError(filename + ' was accumulated for other centrality bins')
+            for (idf, key), acc in averager.acc.items():
+                j = list(averager.bins).index(key)
+                for kind, moments in acc.items():
+                    for field in ['sum_w', 'sum_w2', 'mean', 'm2']:
+                        name = 'acc_{:d}_{:d}_{:s}_{:s}'.format(idf, j, kind, field)
+                        setattr(moments, field, arrays[name])
+        return averager
+
+    def _pT_fluct(self, acc):
+        # mean pT of each bin
+        sums = acc['pT_sums'].mean*acc['pT_sums'].sum_w
+        found = sums[:, 0] > 0.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            M = np.where(found, sums[:, 0]/sums[:, 1], 1.)
+        m = acc['pT_fluct']
+        a, b, ab = m.mean.T
+        m2a, m2b, m2ab = m.m2.T
+        sum_w, sum_w2 = m.sum_w[:, 0], m.sum_w2[:, 0]
+        meanC = a - M*b + M**2
+        # sum of w (x - <x>)^2, with cov(a, b) = (var(a + b) - var(a) - var(b))/2
+        m2 = m2a - M*(m2ab - m2a - m2b) + M**2*m2b
+        with np.errstate(divide='ignore', invalid='ignore'):
+            Neff = sum_w**2/sum_w2
+            stdC = ( m2/sum_w/(Neff-1.+1e-9) ) **.5
+            obs = np.where(found, np.sqrt(meanC)/M, 0.)
+            obs_err = np.where(found, stdC*.5/np.sqrt(meanC)/M, 0.)
+        return obs, obs_err
+
+    def _vn(self, acc):
+        avg_cn2, std_avg_cn2 = acc['vn'].mean_std()
+        obs, obs_err = vn_obs_and_err(avg_cn2, std_avg_cn2)
+        empty = acc['vn'].sum_w == 0.
+        obs[empty] = 0.
+        obs_err[empty] = 0.
+        return obs, obs_err
+
+    def entry(self):
+        """
+        The averaged observables, as one row of bayes_dtype.  Bins without
+        events are NaN.
+        """
+        system = self.system
+        entry = np.zeros(1, dtype=np.dtype(bayes_dtype))
+        species_index = {s: k for k, (s, _) in enumerate(species)}
+        for obs, cent_list in obs_cent_list[system].items():
+            key = np.array(cent_list, dtype=float).tobytes()
+            for idf in range(number_of_viscous_corrections):
+                acc = self.acc[idf, key]
+                if obs in ['dNch_deta', 'dET_deta']:
+                    mean, err = acc[obs].mean_std()
+                elif obs.startswith('dN_dy_') and obs[6:] in dN_dy_species and obs[6:] in species_index:
+                    mean, err = acc['dN_dy'].mean_std()
+                    mean, err = mean[:, species_index[obs[6:]]], err[:, species_index[obs[6:]]]
+                elif obs.startswith('mean_pT_') and obs[8:] in mean_pT_species and obs[8:] in species_index:
+                    mean, err = acc['mean_pT'].mean_std()
+                    mean, err = mean[:, species_index[obs[8:]]], err[:, species_index[obs[8:]]]
+                elif obs == 'pT_fluct':
+                    mean, err = self._pT_fluct(acc)
+                elif obs in ['v22', 'v32', 'v42']:
+                    n = int(obs[1])
+                    mean, err = self._vn(acc)
+                    mean, err = mean[:, n-1], err[:, n-1]
+                else:
+                    continue
+                # bins without events are NaN for every observable
+                empty = acc['dNch_deta'].sum_w == 0.
+                mean = np.where(empty, np.nan, mean)
+                err = np.where(empty, np.nan, err)
+                entry[system][obs]['mean'][:, idf] = mean
+                entry[system][obs]['err'][:, idf] = err
+        return entry
+
+def stream_and_compute(filenames, system, table=None, chunk_size=1000):
+    """
+    Average the events of `filenames` (one or more files of the same design
+    point) for `system` chunk by chunk.  Without a centrality `table` it is
+    computed from the events in a first pass.  Returns the StreamingAverager.
+    """
+    expt_type = expt_for_system[system]
+    if table is None:
+        table = read_centrality_table(filenames, expt_type, centrality_edges(system), chunk_size)
+    averager = StreamingAverager(system, table)
+    for chunk in event_chunks(filenames, expt_type, chunk_size):
+        averager.add(chunk)
+    return averager
+
+def main():
+    parser = argparse.ArgumentParser(description='streaming average of events')
+    parser.add_argument(
+        'events', nargs='*',
+        help='event files, averaged as one design point'
+    )
+    parser.add_argument(
+        '--system', default=system_strs[0], choices=system_strs,
+        help='collision system (default: the first of system_strs)'
+    )
+    parser.add_argument(
+        '--table',
+        help='centrality table file (default: computed from the events)'
+    )
+    parser.add_argument(
+        '--write-table',
+        help='write the centrality table to this file'
+    )
+    parser.add_argument(
+        '--merge', nargs='+', default=[],
+        help='partial accumulator files to merge'
+    )
+    parser.add_argument(
+        '--partial',
+        help='write the accumulators to this file instead of the averages'
+    )
+    parser.add_argument(
+        '-o', '--output',
+        help='file of the averaged observables, one row of bayes_dtype'
+    )
+    parser.add_argument(
+        '--chunk-size', type=int, default=1000,
+        help='number of events read at once'
+    )
+    args = parser.parse_args()
+
+    table = None
+    if args.table:
+        table = np.loadtxt(args.table, ndmin=2)
+
+    averager = None
+    if args.events:
+        print("Averaging events in " + str(args.events))
+        averager = stream_and_compute(args.events, args.system, table, args.chunk_size)
+        table = averager.table
+        print("Number of events : " + str(averager.nevents))
+
+    for filename in args.merge:
+        print("Merging " + filename)
+        partial = StreamingAverager.load(filename)
+        averager = partial if averager is None else averager.merge(partial)
+
+    if averager is None:
+        parser.error('no events or partial accumulators given')
+
+    if args.write_table:
+        np.savetxt(args.write_table, averager.table,
+                   header='centrality %, dNch/deta threshold for each delta-f')
+    if args.partial:
+        averager.save(args.partial)
+        print("accumulators written to " + args.partial)
+    if args.output:
+        averager.entry().tofile(args.output)
+        print("results written to " + args.output)
+
+if __name__ == '__main__':
+    main()
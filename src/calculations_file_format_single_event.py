@@ -2,6 +2,8 @@
 # (or quantities that can be used to compute hadronic observables)
 # for each hydrodynamic event (oversamples or not)
 
+import os
+import numpy as np
 from configurations import *
 
 # species (name, ID) for identified particle observables
@@ -87,3 +89,34 @@ def return_result_dtype(expt_type):
 	                                for (name,_) in Qn_species      ], number_of_viscous_corrections),
 	]
 	return result_dtype
+
+
+def open_events(filename, expt_type):
+	"""
+	Memory-map the events in `filename` read-only, as a structured array of
+	return_result_dtype(expt_type).
+
+	The fields are views into the file, e.g. events[expt_type]['dNch_deta']
+	or events['d_flow_pid']['pion']['Qn'], so only the bytes of the fields
+	(and events) actually indexed are read from disk.  A trailing incomplete
+	event is ignored, as by np.fromfile.
+	"""
+	dtype = np.dtype(return_result_dtype(expt_type))
+	nevents = os.path.getsize(filename) // dtype.itemsize
+	if nevents == 0:
+		return np.zeros(0, dtype=dtype)
+	return np.memmap(filename, dtype=dtype, mode='r', shape=(nevents,))
+
+def event_chunks(filenames, expt_type, chunk_size=1000):
+	"""
+	Iterate over the events of one or more files `filenames` (read in turn,
+	as if concatenated) in chunks of at most `chunk_size` events.  Each chunk
+	is a memory-mapped view as from open_events, so files larger than memory
+	can be processed field by field.
+	"""
+	if isinstance(filenames, (str, os.PathLike)):
+		filenames = [filenames]
+	for filename in filenames:
+		events = open_events(filename, expt_type)
+		for start in range(0, len(events), chunk_size):
+			yield events[start:start + chunk_size]
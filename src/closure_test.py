@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Closure test: calibrate to the model calculations at validation points in
+place of the experimental data, and check that the credible intervals of the
+posterior cover the true parameters.
+
+The emulators and validation calculations are loaded once, then the MCMC of
+many validation points runs concurrently on a pool of processes, each point
+with its own chain file ``<chaindir>/chain-idf-<idf>-pt-<pt>.hdf``.  A
+finished chain is not rerun, and an unfinished one resumes from its last
+checkpoint.  For each point the truth and credible limits are written as by
+:mod:`emulator_truth_vs_dob`, and the coverage of the 60% and 90% intervals
+over all points is written to ``<outdir>/coverage.dat``.  A point that
+fails is reported and left out of the coverage.  Unless
+``--no-plots``, the posterior of each point with its truth is plotted to
+``<outdir>/<pt>-diag_posterior.png``.
+
+Run ``python3 src/closure_test.py --help`` for usage information, e.g. ::
+
+    python3 src/closure_test.py 0-99 1000 --nwalkers 100 --nburnsteps 500 --nprocs 16
+"""
+
+import argparse
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+
+from configurations import *
+from bayes_mcmc import Chain
+from emulator import emulator_registry
+from emulator_truth_vs_dob import load_validation_truth, write_truth_vs_dob
+
+# validation calculations of the workers, inherited from the parent
+_validation_data = None
+
+def load_validation_data():
+    """
+    Return a dict system -> validation model calculations at all validation
+    points.
+    """
+    data = {}
+    for i, s in enumerate(system_strs):
+        print("Loading {:s} validation calculations from ".format(s) + SystemsInfo[s]['validation_obs_file'])
+        data[s] = np.fromfile(SystemsInfo[s]["validation_obs_file"], dtype=[bayes_dtype[i]])[s]
+    return data
+
+def _init_worker(validation_data):
+    global _validation_data
+    _validation_data = validation_data
+    # no-op if the emulators were loaded before forking
+    emulator_registry.preload(systems=system_strs)
+
+def steps_done(chain):
+    """
+    Number of steps of `chain` that run_mcmc resumes from: the chain length
+    at the last saved sampler state, since steps written after it are
+    dropped, or the whole chain if no state was saved.
+    """
+    if not chain.path.exists():
+        return 0
+    with chain.open() as f:
+        for name in ['pt_state', 'emcee_state']:
+            if name in f:
+                return int(f[name].attrs['nsteps'])
+        return f['chain'].shape[1] if 'chain' in f else 0
+
+def closure_point(pt, args):
+    """
+    Run the MCMC of one validation point and write its truth vs. credible
+    limits.  Return whether the truths are inside the 60% and 90% credible
+    intervals.
+    """
+    np.random.seed(args.seed + pt)
+
+    expt_data = {s: _validation_data[s][pt].copy() for s in system_strs}
+    chain = Chain(
+        path=Path(args.chaindir)/'chain-idf-{:d}-pt-{:d}.hdf'.format(idf, pt),
+        expt_data=expt_data
+    )
+
+    nsteps = args.nsteps - steps_done(chain)
+    if nsteps > 0:
+        chain.run_mcmc(
+            nsteps=nsteps,
+            nwalkers=args.nwalkers,
+            nburnsteps=args.nburnsteps,
+            ntemps=args.ntemps,
+            checkpoint=args.checkpoint,
+            nprocs=1,
+            random=np.random.RandomState(args.seed + pt)
+        )
+
+    truth = load_validation_truth(pt)
+    X = chain.draw(args.nsamples).T[:-1]
+    write_truth_vs_dob(pt, truth, X, outdir=args.outdir)
+
+    if not args.no_plots:
+        # diagnostic posterior plot with the truth, as bayes_plot.py diag_posterior
+        import matplotlib.pyplot as plt
+        from bayes_plot import _posterior_diag
+        _posterior_diag(chain, truths=truth + [-1])
+        plt.savefig("{:s}/{:d}-diag_posterior.png".format(args.outdir, pt), dpi=300)
+        plt.close()
+
+    # is the truth inside the 60% and 90% intervals
+    l5, l20, h80, h95 = np.quantile(X, [.05, .2, .8, .95], axis=1)
+    truth = np.array(truth)
+    return (l20 <= truth) & (truth <= h80), (l5 <= truth) & (truth <= h95)
+
+def run_point(job):
+    """
+    Run closure_point for one validation point in its worker process,
+    without a nested pool.  Returns the point, the error if any, and whether
+    the truths are inside the 60% and 90% intervals.
+    """
+    pt, args = job
+    try:
+        in60, in90 = closure_point(pt, args)
+    except Exception as err:
+        return pt, repr(err), None, None
+    return pt, None, in60, in90
+
+def parse_points(arg):
+    """
+    Parse a list of validation points like '0-9,20,25'.
+    """
+    pts = []
+    for part in arg.split(','):
+        first, _, last = part.partition('-')
+        pts += list(range(int(first), int(last or first) + 1))
+    return pts
+
+def main():
+    parser = argparse.ArgumentParser(description='parallel closure test')
+
+    parser.add_argument(
+        'points', type=parse_points,
+        help='validation points, e.g. 0-99 or 0,5,7-9'
+    )
+    parser.add_argument(
+        'nsteps', type=int,
+        help='number of MCMC steps per point'
+    )
+    parser.add_argument(
+        '--nwalkers', type=int, default=100,
+        help='number of walkers'
+    )
+    parser.add_argument(
+        '--nburnsteps', type=int, default=500,
+        help='number of burn-in steps'
+    )
+    parser.add_argument(
+        '--ntemps', type=int, default=10,
+        help='number of points in temperature (for PTSampler only)'
+    )
+    parser.add_argument(
+        '--checkpoint', type=int, default=100,
+        help='number of steps between writes of each chain'
+    )
+    parser.add_argument(
+        '--nsamples', type=int, default=4000,
+        help='number of chain samples for the credible limits'
+    )
+    parser.add_argument(
+        '--nprocs', type=int,
+        help='number of validation points run at once (default: all CPUs)'
+    )
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='random seed; point pt uses seed + pt'
+    )
+    parser.add_argument(
+        '--chaindir', default=str(workdir/'mcmc'/'closure'),
+        help='directory of the chain files'
+    )
+    parser.add_argument(
+        '--outdir', default='validate',
+        help='directory of the truth vs. credible limit files and plots'
+    )
+    parser.add_argument(
+        '--no-plots', action='store_true',
+        help='do not plot the posterior of each point'
+    )
+
+    args = parser.parse_args()
+    Path(args.chaindir).mkdir(parents=True, exist_ok=True)
+    Path(args.outdir).mkdir(parents=True, exist_ok=True)
+
+    # load once, before forking, so the workers share them
+    validation_data = load_validation_data()
+    emulator_registry.preload(systems=system_strs)
+
+    jobs = [(pt, args) for pt in args.points]
+    with Pool(args.nprocs, initializer=_init_worker, initargs=(validation_data,)) as pool:
+        results = []
+        failed = []
+        for pt, err, in60, in90 in pool.imap_unordered(run_point, jobs):
+            if err is None:
+                print("finished validation point " + str(pt))
+                results.append((pt, in60, in90))
+            else:
+                print("FAILED validation point : " + str(pt) + " : " + err)
+                failed.append(pt)
+
+    if failed:
+        print("WARNING : closure test failed for validation pts " + str(sorted(failed)))
+    if not results:
+        print("no validation point finished, coverage not computed")
+        return
+
+    # coverage of the points that finished
+    results.sort()
+    in60 = np.array([r[1] for r in results])
+    in90 = np.array([r[2] for r in results])
+
+    with open("{:s}/coverage.dat".format(args.outdir), 'w') as f:
+        f.write("# {:d} validation points\n".format(len(results)))
+        if failed:
+            f.write("# failed validation points : " + str(sorted(failed)) + "\n")
+        f.write("# index, fraction of truths in 60% interval, in 90% interval\n")
+        for i in range(in60.shape[1]):
+            f.write("{:d}\t{:1.4f}\t{:1.4f}\n".format(i, in60[:, i].mean(), in90[:, i].mean()))
+
+    print("fraction of truths in 60% interval : " + str(in60.mean()))
+    print("fraction of truths in 90% interval : " + str(in90.mean()))
+
+if __name__ == '__main__':
+    main()
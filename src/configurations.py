@@ -180,6 +180,12 @@ print(SystemsInfo)
 #this allows the estimation of the Bayesian evidence
 usePTSampler = True
 
+#if True, the MCMC likelihood factorizes the experimental + PCA truncation
+#covariance once per system and adds the rank-npc emulator covariance of each
+#sample with a Woodbury update, rather than factorizing the full covariance
+#of every sample. The two give the same likelihood.
+use_woodbury_likelihood = True
+
 # if True : perform emulator validation
 # if False : use experimental data for parameter estimation
 validation = False
@@ -366,14 +372,19 @@ def load_design(system_str, pset='main'): # or validation
 #right now this depends on the ordering of parameters
 #we should write a version instead that uses labels in case ordering changes
 
+#the design parameters kept as they are by transform_design (all but the viscous ones),
+#and the temperatures at which it evaluates eta/s and zeta/s
+transform_indices = [0, 1, 2, 3, 4, 5, 6, 15, 16]
+transform_num_T = 10
+transform_T_grid = np.linspace(0.135, 0.4, transform_num_T)
+
 def transform_design(X):
     #pop out the viscous parameters
-    indices = [0, 1, 2, 3, 4, 5, 6, 15, 16]
+    indices = transform_indices
     new_design_X = X[:, indices]
 
     #now append the values of eta/s and zeta/s at various temperatures
-    num_T = 10
-    Temperature_grid = np.linspace(0.135, 0.4, num_T)
+    Temperature_grid = transform_T_grid
     eta_vals = []
     zeta_vals = []
     for pt, T in enumerate(Temperature_grid):
@@ -388,6 +399,46 @@ def transform_design(X):
     new_design_X = np.concatenate( (new_design_X, zeta_vals), axis=1)
     return new_design_X
 
+def transform_design_jacobian(X):
+    """
+    Jacobian of transform_design at the design points X, with shape
+    (npoints, n transformed parameters, n design parameters).
+    """
+    X = np.atleast_2d(X)
+    indices = transform_indices
+    num_T = transform_num_T
+    Temperature_grid = transform_T_grid
+    npts = X.shape[0]
+    J = np.zeros((npts, len(indices) + 2*num_T, X.shape[1]))
+    J[:, np.arange(len(indices)), indices] = 1.
+
+    T = Temperature_grid[np.newaxis, :]
+
+    #eta/s : piecewise linear in T, clipped at zero
+    T_k, alow, ahigh, etas_k = [X[:, i:i+1] for i in range(7, 11)]
+    low = T < T_k
+    slope = np.where(low, alow, ahigh)
+    positive = etas_k + slope*(T - T_k) > 0
+    rows = slice(len(indices), len(indices) + num_T)
+    J[:, rows, 7] = np.where(positive, -slope, 0.)
+    J[:, rows, 8] = np.where(positive & low, T - T_k, 0.)
+    J[:, rows, 9] = np.where(positive & ~low, T - T_k, 0.)
+    J[:, rows, 10] = np.where(positive, 1., 0.)
+
+    #zeta/s : asymmetric Lorentzian in T
+    zmax, T0, width, asym = [X[:, i:i+1] for i in range(11, 15)]
+    DeltaT = T - T0
+    sign = np.where(DeltaT > 0, 1., -1.)
+    w = width*(1. + asym*sign)
+    x = DeltaT/w
+    dz_dx = -2.*zmax*x/(1. + x**2)**2
+    rows = slice(len(indices) + num_T, len(indices) + 2*num_T)
+    J[:, rows, 11] = 1./(1. + x**2)
+    J[:, rows, 12] = -dz_dx/w
+    J[:, rows, 13] = -dz_dx*x/width
+    J[:, rows, 14] = -dz_dx*x*sign/(1. + asym*sign)
+    return J
+
 def prepare_emu_design(system_str):
     design, design_max, design_min, labels = \
                     load_design(system_str=system_str, pset='main')
@@ -436,3 +487,25 @@ MAP_params['Au-Au-200']['CE'] =  [6.24,  0.06,  1.00,  1.19,  2.60,  1.04,  0.02
 
 MAP_params['Pb-Pb-2760']['PTB'] = [13.2,  0.14,  0.98,  0.81,  3.11,  1.46,  0.017,  0.194,  -0.47,   1.62,    0.105,   0.165,     0.194,      0.026,    -0.072,  5.54,  0.147]
 MAP_params['Au-Au-200']['PTB'] =  [5.31,  0.14,  0.98,  0.81,  3.11,  1.46,  0.017,  0.194,  -0.47,   1.62,    0.105,   0.165,     0.194,      0.026,    -0.072,  5.54,  0.147]
+
+def load_MAP_params(path):
+    """
+    Return a dict system -> MAP parameters from a file written by
+    Chain.write_map.
+    """
+    params = {}
+    with open(path) as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            fields = line.split()
+            params[fields[0]] = [float(v) for v in fields[1:]]
+    return params
+
+#MAP parameters found by Chain.find_map (see find_map in bayes_plot.py)
+#replace the values above
+for idf_loc, label in idf_label_short.items():
+    map_file = workdir/'mcmc'/'MAP-idf-{:d}.dat'.format(idf_loc)
+    if map_file.exists():
+        for s, params in load_MAP_params(map_file).items():
+            MAP_params.setdefault(s, {})[label] = params
@@ -14,9 +14,15 @@ and `Gaussian process regression
 <http://scikit-learn.org/stable/modules/generated/sklearn.gaussian_process.GaussianProcessRegressor.html>`_.
 """
 
+from collections.abc import Mapping
+import hashlib
+import inspect
 import logging
+import os
 import pickle
 import dill
+import h5py
+from multiprocessing import Pool
 
 import numpy as np
 import pandas as pd
@@ -27,6 +33,7 @@ from sklearn.decomposition import KernelPCA
 from sklearn.gaussian_process import GaussianProcessRegressor as GPR
 from sklearn.gaussian_process import kernels
 from sklearn.preprocessing import StandardScaler
+from scipy.linalg import solve_triangular
 
 #these are necessary to use the heteroscedastic noise kernel
 #see https://github.com/jmetzen/gp_extras for installation and
@@ -41,6 +48,94 @@ from calculations_load import trimmed_model_data
 ############### Emulator and help functions ###############
 ###########################################################
 
+# version of the compact emulator file format, see Emulator.write_compact
+compact_format_version = 1
+
+#if True, the GPs use a homoscedastic noise kernel, otherwise a heteroscedastic
+#noise kernel estimated on n_clusters clusters of the design points
+use_hom_sced_noise = True
+#choose the number of clusters to estimate the heteroscedastic variance
+n_clusters = 10
+
+#trained emulators are cached here, keyed by a hash of their training inputs
+emulator_cache_dir = 'emulator/cache'
+#version of the cached emulators, part of their hash; increase it when the
+#training changes in a way the hashed settings do not capture
+emulator_cache_version = 1
+
+#noise added to the diagonal of the GP kernel matrix during fitting
+gp_alpha = 0.1
+
+def emulator_kernel(ptp, prototypes=None):
+    """
+    GP kernel of the emulator, given the ranges `ptp` of the design
+    parameters: a Gaussian correlation (RBF) plus a noise term, which is
+    necessary since model calculations contain statistical noise.  The noise
+    is homoscedastic, or heteroscedastic on the cluster centers `prototypes`
+    of the design if given.
+
+    """
+    rbf_kern = 1. * kernels.RBF(
+                  length_scale=ptp,
+                  length_scale_bounds=np.outer(ptp, (4e-1, 1e2)),
+                  #nu = 3.5
+               )
+    if prototypes is None:
+        #homoscedastic noise kernel
+        noise_kern = kernels.WhiteKernel(
+                             noise_level=.1,
+                             noise_level_bounds=(1e-2, 1e2)
+                             )
+    else:
+        #heteroscedastic noise kernel
+        noise_kern = HeteroscedasticKernel.construct(prototypes, 1., (1e-1, 1e1),
+                                                     gamma=1e-5, gamma_bounds="fixed")
+    return rbf_kern + noise_kern
+
+def training_hash(system, npc, idf, nrestarts, seed):
+    """
+    Hash of everything that determines the emulator fit for `system`: the
+    contents of the design and model calculation files, the removed design
+    points, the emulator settings, the GP kernel and its fitting noise, the
+    calibration bins and the cache version.
+
+    """
+    h = hashlib.sha1()
+
+    for filename in [SystemsInfo[system]['main_design_file'],
+                     SystemsInfo[system]['main_obs_file']]:
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+
+    settings = {
+        'system' : system,
+        'npc' : npc,
+        'idf' : idf,
+        'nrestarts' : nrestarts,
+        'seed' : seed,
+        'design_remove_idx' : sorted(SystemsInfo[system]['design_remove_idx']),
+        'use_hom_sced_noise' : use_hom_sced_noise,
+        'n_clusters' : n_clusters,
+        # the kernel definition, for unit parameter ranges (the ranges
+        # themselves follow from the design file)
+        'kernel' : repr(sorted(emulator_kernel(
+            np.ones(1), None if use_hom_sced_noise else np.zeros((1, 1))
+        ).get_params().items())),
+        'gp_alpha' : gp_alpha,
+        'emulator_cache_version' : emulator_cache_version,
+        'do_transform_design' : do_transform_design,
+        'transform_multiplicities' : transform_multiplicities,
+        'calibration_obs_cent_list' : [
+            (obs, np.array(cent_list).tolist())
+            for obs, cent_list in calibration_obs_cent_list[system].items()
+        ],
+    }
+    h.update(repr(sorted(settings.items())).encode())
+
+    return h.hexdigest()
+
+
 class _Covariance:
     """
     Proxy object to extract observable sub-blocks from a covariance array.
@@ -60,6 +155,257 @@ class _Covariance:
         ]
 
 
+def _gp_predict_var(gp, X):
+    """
+    Predictive mean and variance of the fitted sklearn GP `gp` at `X`.
+
+    Equivalent to ``gp.predict(X, return_cov=True)`` followed by taking the
+    diagonal of the covariance, but only the per-sample variances are computed
+    (from the Cholesky factor cached by the fit), so memory is linear in the
+    number of samples instead of quadratic.
+
+    """
+    K_trans = gp.kernel_(X, gp.X_train_)
+    mean = np.dot(K_trans, gp.alpha_)
+
+    # var_i = k(x_i, x_i) - k_i^T.K^-1.k_i  with  K = L.L^T
+    V = solve_triangular(gp.L_, K_trans.T, lower=True, check_finite=False)
+    var = gp.kernel_.diag(X) - np.einsum('ij,ij->j', V, V)
+
+    # undo the target normalization (trivial unless normalize_y=True)
+    y_std = getattr(gp, '_y_train_std', 1.)
+    mean = y_std*mean + getattr(gp, '_y_train_mean', 0.)
+    var *= y_std**2
+
+    # clip round-off negatives, as sklearn does
+    var[var < 0.] = 0.
+
+    return mean, var
+
+
+def _fit_gp(job):
+    """
+    Fit the GP of one principal component from one optimizer start.
+
+    `job` is a tuple ``(design, z, kernel, ipc, start, seed)``.  Start 0
+    optimizes from the initial kernel hyperparameters; start j > 0 from
+    hyperparameters drawn uniformly (in log space) within their bounds, using
+    a random state seeded by (seed, ipc, j).  This reproduces the restarts of
+    sklearn's ``n_restarts_optimizer``, but as independent jobs which can be
+    run in any order or on any process.
+
+    """
+    design, z, kernel, ipc, start, seed = job
+    print("Fitting PC #", ipc, ", optimizer start", start)
+    if start > 0:
+        random_state = np.random.RandomState([seed, ipc, start])
+        bounds = kernel.bounds
+        kernel = kernel.clone_with_theta(
+            random_state.uniform(bounds[:, 0], bounds[:, 1])
+        )
+    return GPR(
+        kernel=kernel,
+        alpha=gp_alpha,
+        n_restarts_optimizer=0,
+        copy_X_train=False
+    ).fit(design, z)
+
+
+class _FusedGP:
+    """
+    Batched predictor for the GPs of all emulated principal components.
+
+    Each sklearn GP recomputes the RBF cross-kernel against the same training
+    design, with only the length scales changing between PCs.  This class
+    stacks the training inputs, ``alpha_`` vectors, Cholesky factors and kernel
+    hyperparameters of all GPs as arrays and evaluates every PC's predictive
+    mean and variance in one NumPy pass.
+
+    It applies to GPs with the homoscedastic emulator kernel
+    ``C * RBF + WhiteKernel`` trained on a common design; use `from_gps` to
+    build it, which returns None for any other kernel.
+
+    """
+    # number of sample points evaluated per pass, limits the size of the
+    # (npc, chunk_size, ntrain) cross-kernel array
+    chunk_size = 1024
+
+    def __init__(self, X_train, alpha, L_inv, amplitude, length_scale,
+                 noise_level, y_mean=0., y_std=1.):
+        # shapes: X_train (ntrain, ndim), alpha (npc, ntrain),
+        # L_inv (npc, ntrain, ntrain), amplitude, noise_level (npc),
+        # length_scale (npc, ndim), y_mean, y_std (npc)
+        # L_inv are the inverses of the Cholesky factors L of the training
+        # covariances, so that the triangular solves of all PCs become one
+        # batched matrix product.
+        npc = alpha.shape[0]
+        self.X_train = X_train
+        self.alpha = alpha
+        self.L_inv = L_inv
+        self.amplitude = amplitude
+        self.length_scale = length_scale
+        self.noise_level = noise_level
+        self.y_mean = np.broadcast_to(y_mean, npc)
+        self.y_std = np.broadcast_to(y_std, npc)
+
+        # Pre-compute the scaled training inputs and their squared norms.
+        self._T = X_train[np.newaxis] / length_scale[:, np.newaxis, :]
+        self._T2 = np.einsum('kjd,kjd->kj', self._T, self._T)
+
+    @classmethod
+    def from_gps(cls, gps):
+        """
+        Stack the fitted sklearn GPs `gps`, or return None if they do not all
+        have the ``C * RBF + WhiteKernel`` kernel and the same training design.
+
+        """
+        X_train = gps[0].X_train_
+        params = []
+        for gp in gps:
+            k = gp.kernel_
+            if not (isinstance(k, kernels.Sum)
+                    and isinstance(k.k1, kernels.Product)
+                    and isinstance(k.k1.k1, kernels.ConstantKernel)
+                    and isinstance(k.k1.k2, kernels.RBF)
+                    and isinstance(k.k2, kernels.WhiteKernel)):
+                return None
+            if not np.array_equal(gp.X_train_, X_train):
+                return None
+            params.append((
+                k.k1.k1.constant_value,
+                np.broadcast_to(k.k1.k2.length_scale, X_train.shape[1]),
+                k.k2.noise_level,
+                np.ravel(getattr(gp, '_y_train_mean', 0.))[0],
+                np.ravel(getattr(gp, '_y_train_std', 1.))[0],
+            ))
+
+        amplitude, length_scale, noise_level, y_mean, y_std = map(np.array, zip(*params))
+
+        eye = np.eye(X_train.shape[0])
+        return cls(
+            np.array(X_train, dtype=float),
+            np.array([gp.alpha_ for gp in gps]),
+            np.array([
+                solve_triangular(gp.L_, eye, lower=True, check_finite=False)
+                for gp in gps
+            ]),
+            amplitude, length_scale, noise_level,
+            y_mean=y_mean, y_std=y_std
+        )
+
+    def predict(self, X, return_var=False):
+        """
+        Predictive means (and variances if `return_var`) of all PCs at `X`,
+        each with shape ``(nsamples, npc)``.
+
+        """
+        X = np.asarray(X, dtype=float)
+        mean = np.empty((X.shape[0], self.alpha.shape[0]))
+        if return_var:
+            var = np.empty_like(mean)
+
+        for start in range(0, X.shape[0], self.chunk_size):
+            chunk = slice(start, start + self.chunk_size)
+
+            # squared scaled distances to the training design, for each PC
+            # shape: (npc, nchunk, ntrain)
+            Xs = X[np.newaxis, chunk] / self.length_scale[:, np.newaxis, :]
+            d2 = np.matmul(Xs, self._T.transpose(0, 2, 1))
+            d2 *= -2.
+            d2 += np.einsum('kid,kid->ki', Xs, Xs)[:, :, np.newaxis]
+            d2 += self._T2[:, np.newaxis, :]
+            np.maximum(d2, 0., out=d2)
+
+            K = np.exp(-.5*d2, out=d2)
+            K *= self.amplitude[:, np.newaxis, np.newaxis]
+
+            mean[chunk] = np.einsum('kij,kj->ik', K, self.alpha)
+
+            if return_var:
+                # var_i = k(x_i, x_i) - |L^-1.k_i|^2
+                V = np.matmul(self.L_inv, K.transpose(0, 2, 1))
+                var[chunk] = (
+                    self.amplitude + self.noise_level
+                    - np.einsum('kji,kji->ik', V, V)
+                )
+
+        mean *= self.y_std
+        mean += self.y_mean
+
+        if not return_var:
+            return mean
+
+        var *= self.y_std**2
+        var[var < 0.] = 0.
+
+        return mean, var
+
+    def predict_grad(self, X):
+        """
+        Predictive means and variances of all PCs at `X`, each with shape
+        ``(nsamples, npc)``, and their gradients with respect to `X`, each with
+        shape ``(nsamples, npc, ndim)``.
+
+        """
+        X = np.asarray(X, dtype=float)
+        npc, ndim = self.length_scale.shape
+        mean = np.empty((X.shape[0], npc))
+        var = np.empty_like(mean)
+        dmean = np.empty((X.shape[0], npc, ndim))
+        dvar = np.empty_like(dmean)
+
+        # d k(x, x_j)/dx = -k(x, x_j) (x - x_j)/l^2, so each gradient is
+        # -(x S0 - S1)/l^2 with S0 = sum_j w_j k_j and S1 = sum_j w_j k_j x_j
+        inv_l2 = self.length_scale**-2.
+
+        for start in range(0, X.shape[0], self.chunk_size):
+            chunk = slice(start, start + self.chunk_size)
+            x = X[chunk]
+
+            Xs = x[np.newaxis] / self.length_scale[:, np.newaxis, :]
+            d2 = np.matmul(Xs, self._T.transpose(0, 2, 1))
+            d2 *= -2.
+            d2 += np.einsum('kid,kid->ki', Xs, Xs)[:, :, np.newaxis]
+            d2 += self._T2[:, np.newaxis, :]
+            np.maximum(d2, 0., out=d2)
+
+            K = np.exp(-.5*d2, out=d2)
+            K *= self.amplitude[:, np.newaxis, np.newaxis]
+
+            # mean: weights alpha_j
+            Ka = K * self.alpha[:, np.newaxis, :]
+            mean[chunk] = Ka.sum(axis=2).T
+            dmean[chunk] = -(
+                x[np.newaxis] * mean[chunk].T[:, :, np.newaxis]
+                - np.matmul(Ka, self.X_train)
+            ).transpose(1, 0, 2) * inv_l2
+
+            # variance: var = k(x, x) - |L^-1.k|^2 has weights
+            # -2 (L^-T.L^-1.k)_j
+            V = np.matmul(self.L_inv, K.transpose(0, 2, 1))
+            var[chunk] = (
+                self.amplitude + self.noise_level
+                - np.einsum('kji,kji->ik', V, V)
+            )
+            KQ = K * np.matmul(self.L_inv.transpose(0, 2, 1), V).transpose(0, 2, 1)
+            dvar[chunk] = 2.*(
+                x[np.newaxis] * KQ.sum(axis=2)[:, :, np.newaxis]
+                - np.matmul(KQ, self.X_train)
+            ).transpose(1, 0, 2) * inv_l2
+
+        mean *= self.y_std
+        mean += self.y_mean
+        dmean *= self.y_std[:, np.newaxis]
+
+        var *= self.y_std**2
+        dvar *= (self.y_std**2)[:, np.newaxis]
+        clipped = var < 0.
+        var[clipped] = 0.
+        dvar[clipped] = 0.
+
+        return mean, var, dmean, dvar
+
+
 class Emulator:
     """
     Multidimensional Gaussian process emulator using principal component
@@ -71,6 +417,15 @@ class Emulator:
     remaining components are neglected, which is equivalent to assuming they
     are standard zero-mean unit-variance GPs.
 
+    The emulator is trained on the model calculations with viscous correction
+    `idf` (default: idf in configurations.py).  The output of
+    prepare_emu_design(system_str) may be passed as `emu_design` to share it
+    between emulators of the same system.
+
+    Each optimizer start (`nrestarts` + 1 per PC) is fit as an independent,
+    deterministically seeded job, optionally spread over `nprocs` processes.
+    The result does not depend on `nprocs`.
+
     This class has become a bit messy but it still does the job.  It would
     probably be better to refactor some of the data transformations /
     preprocessing into modular classes, to be used with an sklearn pipeline.
@@ -79,7 +434,8 @@ class Emulator:
 
     """
 
-    def __init__(self, system_str, npc, nrestarts=2):
+    def __init__(self, system_str, npc, idf=idf, nrestarts=2, nprocs=1, seed=1,
+                 emu_design=None):
         print("Emulators for system " + system_str)
         print("with viscous correction type {:d}".format(idf))
         print("NPC : " + str(npc) )
@@ -166,7 +522,9 @@ class Emulator:
         plt.savefig('PCA.png', dpi=400)
         """
 
-        design, design_max, design_min, labels = prepare_emu_design(system_str)
+        if emu_design is None:
+            emu_design = prepare_emu_design(system_str)
+        design, design_max, design_min, labels = emu_design
 
         #delete undesirable data
         delete_design_pts_set = SystemsInfo[system_str]["design_remove_idx"]
@@ -176,51 +534,42 @@ class Emulator:
 
         ptp = design_max - design_min
         print("Design shape[Ndesign, Nparams] = " + str(design.shape))
-        # Define kernel (covariance function):
-        # Gaussian correlation (RBF) plus a noise term.
-        # noise term is necessary since model calculations contain statistical noise
-        rbf_kern = 1. * kernels.RBF(
-                      length_scale=ptp,
-                      length_scale_bounds=np.outer(ptp, (4e-1, 1e2)),
-                      #nu = 3.5
-                   )
-        const_kern = kernels.ConstantKernel()
-        #homoscedastic noise kernel
-        hom_white_kern = kernels.WhiteKernel(
-                                 noise_level=.1,
-                                 noise_level_bounds=(1e-2, 1e2)
-                                 )
-
-        #choose the number of clusters to estimate the heteroscedastic variance
-        n_clusters = 10
-        use_hom_sced_noise = True
 
         # Fit a GP (optimize the kernel hyperparameters) to each PC.
-        self.gps = []
+        # Every optimizer start of every PC is an independent job, seeded
+        # deterministically, so that the serial and parallel builds agree.
+        jobs = []
         for i, z in enumerate(Z.T):
-            print("Fitting PC #", i)
             if use_hom_sced_noise:
-                kernel = (rbf_kern + hom_white_kern)
+                kernel = emulator_kernel(ptp)
             else:
-                #heteroscedastic noise kernel
                 prototypes = KMeans(n_clusters=n_clusters).fit(design).cluster_centers_
-                het_noise_kern = HeteroscedasticKernel.construct(prototypes, 1., (1e-1, 1e1),
-                                                                gamma=1e-5, gamma_bounds="fixed")
-                kernel = (rbf_kern + het_noise_kern)
-
-            self.gps.append(
-                GPR(
-                kernel=kernel,
-                #alpha=0.01,
-                alpha=0.1,
-                n_restarts_optimizer=nrestarts,
-                copy_X_train=False
-                ).fit(design, z)
-            )
+                kernel = emulator_kernel(ptp, prototypes)
+
+            for start in range(nrestarts + 1):
+                jobs.append((design, z, kernel, i, start, seed))
+
+        if nprocs > 1:
+            print("Fitting {:d} GP optimizer starts on {:d} processes".format(len(jobs), nprocs))
+            with Pool(nprocs) as pool:
+                fits = pool.map(_fit_gp, jobs)
+        else:
+            fits = list(map(_fit_gp, jobs))
+
+        # keep the start with the highest log marginal likelihood for each PC
+        self.gps = []
+        for i in range(npc):
+            self.gps.append(max(
+                (gp for job, gp in zip(jobs, fits) if job[3] == i),
+                key=lambda gp: gp.log_marginal_likelihood_value_
+            ))
 
         for n, (z, gp) in enumerate(zip(Z.T, self.gps)):
             print("GP " + str(n) + " score : " + str(gp.score(design, z)))
 
+        # Stack the GPs for fast batched prediction (None if not applicable).
+        self._fused = _FusedGP.from_gps(self.gps)
+
         print("Constructing full linear transformation matrix")
         # Construct the full linear transformation matrix, which is just the PC
         # matrix with the first axis multiplied by the explained standard
@@ -259,10 +608,151 @@ class Emulator:
         self._cov_trunc.flat[::self.nobs + 1] += 1e-4 * self.scaler.var_
 
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # emulators pickled before the fused predictor was introduced
+        if '_fused' not in state:
+            self._fused = _FusedGP.from_gps(self.gps)
+
+    # arrays of the compact file format, as attributes of the fused predictor
+    _compact_fused_arrays = [
+        'X_train', 'alpha', 'L_inv', 'amplitude', 'length_scale',
+        'noise_level', 'y_mean', 'y_std'
+    ]
+
+    def write_compact(self, path):
+        """
+        Write only what prediction needs, as plain arrays, to the HDF5 file
+        `path`: the stacked GP arrays of the fused predictor, the PCA
+        transformation of the emulated PCs and of their variance, the
+        standardization, the truncation covariance and the observable slices.
+
+        The datasets are stored contiguous and uncompressed, so that
+        read_compact can memory-map them.  The file contains no pickled
+        objects and does not depend on the sklearn version.
+
+        """
+        if self._fused is None:
+            raise ValueError(
+                'the compact format requires the C * RBF + WhiteKernel kernel'
+            )
+
+        with h5py.File(path, 'w') as f:
+            f.attrs['format_version'] = compact_format_version
+            f.attrs['npc'] = self.npc
+            f.attrs['nobs'] = self.nobs
+            f.attrs['observables'] = np.array(self.observables, dtype='S')
+
+            for name in self._compact_fused_arrays:
+                f.create_dataset(name, data=np.asarray(getattr(self._fused, name), dtype=float))
+
+            f.create_dataset('trans_matrix', data=self._trans_matrix[:self.npc])
+            f.create_dataset('var_trans', data=self._var_trans)
+            f.create_dataset('cov_trunc', data=self._cov_trunc)
+            f.create_dataset('scaler_mean', data=self.scaler.mean_)
+            f.create_dataset('scaler_scale', data=self.scaler.scale_)
+            f.create_dataset('slices', data=np.array([
+                (self._slices[obs].start, self._slices[obs].stop)
+                for obs in self.observables
+            ], dtype=int_t))
+
+    @classmethod
+    def read_compact(cls, path, mmap=True):
+        """
+        Load an emulator written by write_compact.  If `mmap` is true, the
+        arrays are memory-mapped read-only, so loading is near-instant and the
+        pages are shared by all processes reading the same file.
+
+        The returned emulator supports predict_pcs and predict but, unlike a
+        dill'ed emulator, has no sklearn objects (gps and pca are None), so it
+        can not be used with sample_y or the PCA diagnostics.
+
+        """
+        with h5py.File(path, 'r') as f:
+            version = f.attrs['format_version']
+            if version != compact_format_version:
+                raise ValueError(
+                    'unsupported compact emulator format version {} in {}'
+                    .format(version, path)
+                )
+            npc = int(f.attrs['npc'])
+            nobs = int(f.attrs['nobs'])
+            observables = [obs.decode() for obs in f.attrs['observables']]
+
+            arrays = {}
+            for name, dset in f.items():
+                offset = dset.id.get_offset()
+                if mmap and offset is not None:
+                    arrays[name] = np.memmap(
+                        path, mode='r', dtype=dset.dtype,
+                        shape=dset.shape, offset=offset
+                    )
+                else:
+                    arrays[name] = dset[()]
+
+        emu = cls.__new__(cls)
+        emu.npc = npc
+        emu.nobs = nobs
+        emu.observables = observables
+        emu._slices = {
+            obs: slice(int(start), int(stop))
+            for obs, (start, stop) in zip(observables, arrays['slices'])
+        }
+        emu.gps = None
+        emu.pca = None
+
+        emu.scaler = StandardScaler()
+        emu.scaler.mean_ = arrays['scaler_mean']
+        emu.scaler.scale_ = arrays['scaler_scale']
+        emu.scaler.var_ = emu.scaler.scale_**2
+
+        A = emu._trans_matrix = arrays['trans_matrix']
+        # files written before var_trans was stored
+        if 'var_trans' in arrays:
+            emu._var_trans = arrays['var_trans']
+        else:
+            emu._var_trans = np.einsum('ki,kj->kij', A, A, optimize=False).reshape(npc, nobs**2)
+        emu._cov_trunc = arrays['cov_trunc']
+
+        emu._fused = _FusedGP(*[arrays[name] for name in cls._compact_fused_arrays])
+
+        return emu
+
     @classmethod
     def build_emu(cls, system, retrain=False, **kwargs):
+        """
+        Return the emulator for `system`, trained with the constructor
+        arguments `kwargs`.
+
+        Trained emulators are cached in `emulator_cache_dir`, under a hash of
+        everything that determines the fit (see training_hash).  On a cache
+        hit the stored emulator is reused, unless `retrain` is true; on a miss
+        (or with `retrain`) the emulator is trained and stored.
+
+        """
+        args = inspect.signature(cls).bind(system, **kwargs)
+        args.apply_defaults()
+        key = training_hash(
+            system, args.arguments['npc'], args.arguments['idf'],
+            args.arguments['nrestarts'], args.arguments['seed']
+        )
+        cache_file = os.path.join(
+            emulator_cache_dir, 'emulator-{:s}-idf-{:d}-{:s}.dill'.format(
+                system, args.arguments['idf'], key
+            )
+        )
+
+        if not retrain and os.path.exists(cache_file):
+            print("Using cached emulator " + cache_file)
+            with open(cache_file, 'rb') as file:
+                return dill.load(file)
+
         emu = cls(system, **kwargs)
 
+        os.makedirs(emulator_cache_dir, exist_ok=True)
+        with open(cache_file, 'wb') as file:
+            dill.dump(emu, file)
+
         return emu
 
     def _inverse_transform(self, Z):
@@ -298,6 +788,80 @@ class Emulator:
             obs: Y[..., s] for obs, s in self._slices.items()
         }
 
+    def predict_pcs(self, X, return_var=False, extra_std=0):
+        """
+        Predict the emulated principal components at `X`.
+
+        Returns the GP predictive means with shape ``(nsamples, npc)``.  If
+        `return_var` is true, return a tuple ``(mean, var)`` where `var` holds
+        the GP predictive variances of each PC at each sample point, with the
+        same shape, including the `extra_std` uncertainty (see `predict`).
+
+        The observables are recovered from the PCs by the linear map
+        ``Y = Z . _trans_matrix[:npc] + scaler.mean_``, so the PC variances
+        fully specify the rank-`npc` part of the predictive covariance.
+
+        """
+        if do_transform_design:
+            X = transform_design(X)
+
+        if self._fused is not None:
+            if not return_var:
+                return self._fused.predict(X)
+            mean, var = self._fused.predict(X, return_var=True)
+        elif not return_var:
+            # shape: (nsamples, npc)
+            return np.concatenate([
+                gp.predict(X)[:, np.newaxis] for gp in self.gps
+            ], axis=1)
+        else:
+            gp_mean, gp_var = zip(*[_gp_predict_var(gp, X) for gp in self.gps])
+
+            mean = np.concatenate([m[:, np.newaxis] for m in gp_mean], axis=1)
+
+            # Build array of the GP predictive variances at each sample point.
+            var = np.concatenate([v[:, np.newaxis] for v in gp_var], axis=1)
+
+        # Add extra uncertainty to predictive variance.
+        extra_std = np.array(extra_std, copy=False).reshape(-1, 1)
+        var += extra_std**2
+
+        return mean, var
+
+    def predict_pcs_grad(self, X, extra_std=0):
+        """
+        Predict the emulated principal components at `X` with their gradients.
+
+        Returns a tuple ``(mean, var, dmean, dvar)``: the PC predictive means
+        and variances as from `predict_pcs` with ``return_var=True``, and their
+        gradients with respect to the (untransformed) design parameters `X`,
+        with shape ``(nsamples, npc, ndim)``.  The gradients are chained through
+        `transform_design` if it applies.  The derivative of `var` with respect
+        to `extra_std` is simply ``2*extra_std``.
+
+        Requires the fused GP predictor (the homoscedastic emulator kernel).
+
+        """
+        if self._fused is None:
+            raise ValueError(
+                'analytic gradients need the fused GP predictor, '
+                'i.e. the homoscedastic emulator kernel'
+            )
+
+        X = np.asarray(X, dtype=float)
+        if do_transform_design:
+            J = transform_design_jacobian(X)
+            mean, var, dmean, dvar = self._fused.predict_grad(transform_design(X))
+            dmean = np.matmul(dmean, J)
+            dvar = np.matmul(dvar, J)
+        else:
+            mean, var, dmean, dvar = self._fused.predict_grad(X)
+
+        extra_std = np.asarray(extra_std).reshape(-1, 1)
+        var += extra_std**2
+
+        return mean, var, dmean, dvar
+
     def predict(self, X, return_cov=False, extra_std=0):
         """
         Predict model output at `X`.
@@ -336,29 +900,16 @@ class Emulator:
         may either be a scalar or an array-like of length nsamples.
 
         """
-        if do_transform_design:
-            X = transform_design(X)
-
-        gp_mean = [gp.predict(X, return_cov=return_cov) for gp in self.gps]
-
         if return_cov:
-            gp_mean, gp_cov = zip(*gp_mean)
+            gp_mean, gp_var = self.predict_pcs(
+                X, return_var=True, extra_std=extra_std
+            )
+        else:
+            gp_mean = self.predict_pcs(X)
 
-        mean = self._inverse_transform(
-            np.concatenate([m[:, np.newaxis] for m in gp_mean], axis=1)
-        )
+        mean = self._inverse_transform(gp_mean)
 
         if return_cov:
-            # Build array of the GP predictive variances at each sample point.
-            # shape: (nsamples, npc)
-            gp_var = np.concatenate([
-                c.diagonal()[:, np.newaxis] for c in gp_cov
-            ], axis=1)
-
-            # Add extra uncertainty to predictive variance.
-            extra_std = np.array(extra_std, copy=False).reshape(-1, 1)
-            gp_var += extra_std**2
-
             # Compute the covariance at each sample point using the
             # pre-calculated arrays (see constructor).
             cov = np.dot(gp_var, self._var_trans).reshape(
@@ -393,6 +944,161 @@ class Emulator:
             ], axis=2)
         )
 
+def emulator_file(system, idf_loc=idf, compact=False):
+    """
+    Path of the trained emulator file for `system` and viscous correction
+    `idf_loc`: the dill'ed Emulator object, or the compact array file if
+    `compact` is true.
+
+    """
+    ext = '.h5' if compact else '.dill'
+    return 'emulator/emulator-' + system + '-idf-' + str(idf_loc) + ext
+
+def write_emulator(emu, system, idf_loc=idf):
+    """
+    Dill the emulator `emu` to be loaded later, and write its compact array
+    file used for prediction (if its kernel allows it).
+
+    """
+    with open(emulator_file(system, idf_loc), 'wb') as file:
+        dill.dump(emu, file)
+
+    compact_file = emulator_file(system, idf_loc, compact=True)
+    if emu._fused is not None:
+        emu.write_compact(compact_file)
+    elif os.path.exists(compact_file):
+        # don't leave a stale compact file behind
+        os.remove(compact_file)
+
+def load_emulator(system, idf_loc=idf, compact=True):
+    """
+    Load the trained emulator for `system` and viscous correction `idf_loc`.
+
+    If `compact` is true and an up-to-date compact file exists, it is
+    memory-mapped (see Emulator.read_compact); otherwise the full Emulator
+    object is unpickled, as needed e.g. for sample_y and the PCA diagnostics.
+
+    """
+    dill_file = emulator_file(system, idf_loc)
+    compact_file = emulator_file(system, idf_loc, compact=True)
+    if compact and os.path.exists(compact_file) and (
+            not os.path.exists(dill_file)
+            or os.path.getmtime(compact_file) >= os.path.getmtime(dill_file)
+    ):
+        return Emulator.read_compact(compact_file)
+
+    with open(dill_file, 'rb') as file:
+        return dill.load(file)
+
+def _build_and_write(job):
+    """
+    Train and write the emulator of one (system, idf) pair of the build
+    matrix, for use with Pool.imap_unordered.
+
+    """
+    s, idf_loc, emu_design, kwargs = job
+    emu = Emulator.build_emu(
+        s, npc=SystemsInfo[s]['npc'], idf=idf_loc, emu_design=emu_design, **kwargs
+    )
+    write_emulator(emu, s, idf_loc)
+    return s, idf_loc
+
+def build_all(nprocs=None, **kwargs):
+    """
+    Train the emulators of every system for every viscous correction model
+    and write them as they finish.  The (system, idf) pairs are spread over
+    `nprocs` processes (default: all CPUs); the GPs of each emulator are then
+    fit serially in its process.  The transformed designs are prepared once
+    and shared by all emulators of a system.
+
+    """
+    emu_designs = { s: prepare_emu_design(s) for s in system_strs }
+    jobs = [
+        (s, idf_loc, emu_designs[s], kwargs)
+        for s in system_strs
+        for idf_loc in range(number_of_models_per_run)
+    ]
+
+    with Pool(nprocs) as pool:
+        for s, idf_loc in pool.imap_unordered(_build_and_write, jobs):
+            print("Wrote " + emulator_file(s, idf_loc))
+
+class _RegistryView(Mapping):
+    """
+    Read-only dict-like view of an EmulatorRegistry along one key (system or
+    idf), whose items are only loaded when accessed.
+
+    """
+    def __init__(self, get, keys):
+        self._get = get
+        self._keys = list(keys)
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        return self._get(key)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+class EmulatorRegistry:
+    """
+    Cache of trained emulators, keyed by (system, idf).  An emulator is loaded
+    (see load_emulator) the first time it is requested, so that importing
+    this module costs nothing.  Use `preload` to load a chosen subset up
+    front, e.g. before forking worker processes.
+
+    """
+    def __init__(self, systems=system_strs, idfs=range(number_of_models_per_run)):
+        self.systems = list(systems)
+        self.idfs = list(idfs)
+        self._emulators = {}
+
+    def get(self, system, idf_loc=idf):
+        """
+        Return the emulator for `system` and viscous correction `idf_loc`,
+        loading it on first use.
+
+        """
+        key = (system, idf_loc)
+        try:
+            return self._emulators[key]
+        except KeyError:
+            pass
+        emu = self._emulators[key] = load_emulator(system, idf_loc)
+        return emu
+
+    def preload(self, systems=None, idfs=None):
+        """
+        Load the emulators of the given `systems` (default: all) and `idfs`
+        (default: the idf in configurations.py).  Missing emulators are
+        reported and skipped.
+
+        """
+        for s in (self.systems if systems is None else systems):
+            for idf_loc in ([idf] if idfs is None else idfs):
+                try:
+                    self.get(s, idf_loc)
+                except (IOError, OSError):
+                    print("WARNING! Can't load emulator for system " + s + " for idf " + str(idf_loc))
+
+    def for_idf(self, idf_loc):
+        """
+        Mapping system -> emulator for viscous correction `idf_loc`.
+
+        """
+        return _RegistryView(lambda s: self.get(s, idf_loc), self.systems)
+
+    def for_system(self, system):
+        """
+        Mapping idf -> emulator of `system`.
+
+        """
+        return _RegistryView(lambda idf_loc: self.get(system, idf_loc), self.idfs)
+
 def main():
     import argparse
 
@@ -406,14 +1112,29 @@ def main():
         help='number of optimizer restarts'
     )
 
+    parser.add_argument(
+        '--nprocs', type=int,
+        help='number of processes used to fit the GPs in parallel'
+    )
+
     parser.add_argument(
         '--retrain', action='store_true',
-        help='retrain even if emulator is cached'
+        help='retrain even if emulator is cached (with identical inputs)'
+    )
+
+    parser.add_argument(
+        '--all-idf', action='store_true',
+        help='train the emulators for all viscous corrections (idf) of all '
+             'systems at once, on a pool of --nprocs processes'
     )
 
     args = parser.parse_args()
     kwargs = vars(args)
 
+    if kwargs.pop('all_idf', False):
+        build_all(**kwargs)
+        return
+
     for s in system_strs:
         print("system = " + str(s), ", npc = ", SystemsInfo[s]['npc'])
         emu = Emulator.build_emu(s, npc=SystemsInfo[s]['npc'], **kwargs)
@@ -433,26 +1154,19 @@ def main():
         #    )
 
         #dill the emulator to be loaded later
-        with open('emulator/emulator-' + s + '-idf-' + str(idf) + '.dill', 'wb') as file:
-            dill.dump(emu, file)
+        write_emulator(emu, s)
 
 
 if __name__ == "__main__":
     main()
 
-Trained_Emulators = {}
-for s in system_strs:
-    try:
-        Trained_Emulators[s] = dill.load(open('emulator/emulator-' + s + '-idf-' + str(idf) + '.dill', "rb"))
-    except:
-        print("WARNING! Can't load emulator for system " + s)
-
-#contains all the emulators for all df models
-Trained_Emulators_all_df = {}
-for s in system_strs:
-    Trained_Emulators_all_df[s] = {}
-    for idf_loc in [0, 1, 2, 3]:
-        try:
-            Trained_Emulators_all_df[s][idf_loc] = dill.load(open('emulator/emulator-' + s + '-idf-' + str(idf_loc) + '.dill', "rb"))
-        except:
-            print("WARNING! Can't load emulator for system " + s + " for idf " + str(idf_loc))
+#lazily loaded emulators for all systems and df models
+emulator_registry = EmulatorRegistry()
+
+#emulators for the df model specified by idf, by system
+Trained_Emulators = emulator_registry.for_idf(idf)
+
+#contains all the emulators for all df models, by system and idf
+Trained_Emulators_all_df = {
+    s: emulator_registry.for_system(s) for s in system_strs
+}
@@ -305,9 +305,9 @@ def main():
 
         print("Validation design set shape : (Npoints, Nparams) =  ", design.shape)
 
-        #load the dill'ed emulator from emulator file
-        print("Loading emulators from emulator/emulator-" + s + '-idf-' + str(idf) + '.dill' )
-        emu = dill.load(open('emulator/emulator-' + s + '-idf-' + str(idf) + '.dill', "rb"))
+        #load the emulator from emulator file
+        print("Loading emulators from " + emulator_file(s))
+        emu = load_emulator(s)
         print("NPC = " + str(emu.npc))
         print("idf = " + str(idf))
 
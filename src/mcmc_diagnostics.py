@@ -1,4 +1,5 @@
 import numpy as np
+from scipy.fft import next_fast_len, rfft, irfft
 
 def autocorrelation(chain, max_percent_lag):
 
@@ -24,3 +25,102 @@ def autocorrelation(chain, max_percent_lag):
         normalization *= np.sqrt(np.dot(shifted, shifted))
         acors[lag] = np.dot(unshifted, shifted) / normalization
     return acors
+
+def autocorrelation_fft(x, axis=0):
+
+    """Return the autocorrelation function at all lags of the
+    time series in `x` along `axis`, computed with FFTs.  All other
+    axes (e.g. walkers and parameters) are independent series,
+    done in one vectorized pass.  A constant series is taken to be
+    fully correlated."""
+
+    # transform along the last, contiguous axis
+    x = np.moveaxis(np.asarray(x, dtype=float), axis, -1)
+    n = x.shape[-1]
+    x = x - x.mean(axis=-1, keepdims=True)
+    # zero-pad to >= 2n to avoid circular correlation
+    nfft = next_fast_len(2*n, real=True)
+    f = rfft(x, n=nfft, axis=-1, workers=-1)
+    acf = irfft(f.real**2 + f.imag**2, n=nfft, axis=-1, workers=-1)[..., :n]
+    var = acf[..., :1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        acf = np.where(var > 0, acf / var, 1.)
+    return np.moveaxis(acf, -1, axis)
+
+def integrated_time(acf, c=5):
+
+    """Return the integrated autocorrelation time from the
+    autocorrelation function `acf`, with lags along the first axis,
+    using the automatic window of Sokal: the smallest window M with
+    M >= c*tau(M)."""
+
+    acf = np.asarray(acf)
+    taus = 2*np.cumsum(acf, axis=0) - 1
+    inside = np.arange(len(acf)).reshape((-1,) + (1,)*(acf.ndim - 1)) < c*taus
+    # first lag outside the window, or the last lag if there is none
+    window = np.where(inside.all(axis=0), len(acf) - 1, np.argmin(inside, axis=0))
+    return np.take_along_axis(taus, window[np.newaxis], axis=0)[0]
+
+def chain_autocorrelation(chain, thin=1, steps_per_block=1000, walkers_per_block=20, c=5):
+
+    """Autocorrelation of an MCMC chain of shape (nwalkers, nsteps, ndim),
+    an array or an HDF5 dataset.  The chain is read `walkers_per_block`
+    walkers at a time (each in blocks of `steps_per_block` steps), and the
+    autocorrelation function of every walker and parameter of the block is
+    computed with FFTs and summed, so memory is bounded by one block of
+    walkers.  Since the HDF5 chunks hold all walkers of a step, each block
+    reads through the file once; larger blocks mean fewer passes.
+
+    Returns the walker-averaged autocorrelation function (nsteps, ndim),
+    and per parameter the integrated autocorrelation time (in thinned
+    steps) and the effective sample size of the whole chain."""
+
+    nwalkers, nsteps, ndim = chain.shape
+    steps = np.arange(0, nsteps, thin)
+
+    acf = 0.
+    for w in range(0, nwalkers, walkers_per_block):
+        walkers = slice(w, min(w + walkers_per_block, nwalkers))
+        # (walkers, ndim, nsteps), so that each series is contiguous
+        x = np.empty((walkers.stop - walkers.start, ndim, steps.size))
+        for i in range(0, steps.size, steps_per_block):
+            block = steps[i:i+steps_per_block]
+            x[:, :, i:i+block.size] = np.transpose(
+                chain[walkers, block[0]:block[-1]+1:thin], (0, 2, 1)
+            )
+        acf = acf + autocorrelation_fft(x, axis=-1).sum(axis=0)
+    acf = acf.T / nwalkers
+
+    tau = integrated_time(acf, c=c)
+    ess = nwalkers*acf.shape[0] / tau
+    return acf, tau, ess
+
+def main():
+    import argparse
+    import h5py
+
+    parser = argparse.ArgumentParser(
+        description='integrated autocorrelation time and effective sample size of an MCMC chain'
+    )
+    parser.add_argument('chain', help='chain HDF5 file')
+    parser.add_argument('--thin', type=int, default=1, help='use every thin-th step')
+    parser.add_argument(
+        '--walkers-per-block', type=int, default=20,
+        help='number of walkers read from the file and transformed at a time'
+    )
+    args = parser.parse_args()
+
+    with h5py.File(args.chain, 'r') as f:
+        dset = f['chain']
+        nwalkers, nsteps, ndim = dset.shape
+        print("{:d} walkers, {:d} steps, {:d} parameters".format(nwalkers, nsteps, ndim))
+        acf, tau, ess = chain_autocorrelation(
+            dset, thin=args.thin, walkers_per_block=args.walkers_per_block
+        )
+
+    print("param     tau        ESS")
+    for i in range(ndim):
+        print("{:5d} {:8.1f} {:10.0f}".format(i, tau[i]*args.thin, ess[i]))
+
+if __name__ == '__main__':
+    main()
@@ -8,7 +8,7 @@ import altair as alt
 import dill
 import matplotlib.pyplot as plt
 from configurations import *
-from emulator import Trained_Emulators, _Covariance
+from emulator import Trained_Emulators, _Covariance, load_emulator
 from bayes_exp import Y_exp_data
 from bayes_plot import obs_tex_labels_2
 
@@ -89,7 +89,7 @@ def load_design(system):
 @st.cache(allow_output_mutation=True, show_spinner=False)
 def load_emu(system, idf):
     #load the emulator
-    emu = dill.load(open('emulator/emulator-' + system + '-idf-' + str(idf) + '.dill', "rb"))
+    emu = load_emulator(system, idf)
     return emu
 
 @st.cache(persist=True)